@@ -32,6 +32,8 @@ setup(
     [console_scripts]
     flask-ctl = presence_analyzer.script:run
     download_users = presence_analyzer.script:download_xml
+    compile_snapshot = presence_analyzer.script:compile_snapshot
+    benchmark = presence_analyzer.benchmark:run
 
     [paste.app_factory]
     main = presence_analyzer.script:make_app
@@ -0,0 +1,430 @@
+# -*- coding: utf-8 -*-
+"""
+Performance benchmarks.
+
+Suite generates presence CSV and users XML of several sizes and times
+loaders, aggregators and API views on them. Larger ingest sizes, millions
+of rows by default, time only CSV parsing and store loading. Results can be
+saved as JSON baseline and compared with later runs.
+"""
+import argparse
+import csv
+import gc
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+from multiprocessing import cpu_count
+
+from presence_analyzer import utils
+from presence_analyzer.main import app
+
+
+NAMES = (
+    u'Adam', u'Agnieszka', u'Bartłomiej', u'Celina', u'Dariusz', u'Ewa',
+    u'Łukasz', u'Małgorzata', u'Paweł', u'Żaneta', u'Zbigniew', u'Ścibor',
+)
+
+# API views with their URLs, {user} is replaced with user id
+VIEWS = (
+    ('users', '/api/v1/users'),
+    ('months', '/api/v1/months'),
+    ('top5monthly', '/api/v1/top5monthly/September'),
+    ('user_image', '/api/v1/user_image/{user}'),
+    ('presence_weekday', '/api/v1/presence_weekday/{user}'),
+    ('mean_time_weekday', '/api/v1/mean_time_weekday/{user}'),
+    ('presence_start_end', '/api/v1/presence_start_end/{user}'),
+    ('presence_weekday_range',
+     '/api/v1/presence_weekday/{user}?from=2011-01-01&to=2011-06-30'),
+    ('bulk', '/api/v1/bulk/presence_weekday'),
+    ('aggregate', '/api/v1/aggregate/presence_start_end'),
+    ('aggregate_range',
+     '/api/v1/aggregate/presence_month?from=2011-01-01&to=2011-12-31'),
+)
+
+# metrics which are better when lower, others are rates
+LATENCIES = ('p50', 'p99', 'seconds', 'peak_rss_kb')
+
+
+def generate_csv(path, users=300, years=1, malformed=0.0, seed=0):
+    """
+    Writes presence CSV of users working every weekday for given years.
+
+    Rows are grouped by user like the intranet export. Malformed is the
+    fraction of lines which can't be parsed. Returns amount of lines.
+    """
+    rand = random.Random(seed)
+    first_day = date(2011, 1, 1)
+    days = [
+        first_day + timedelta(days=offset)
+        for offset in xrange((date(2011 + years, 1, 1) - first_day).days)
+    ]
+    written = 0
+    with open(path, 'w') as csvfile:
+        for user_id in xrange(users):
+            for day in days:
+                if day.weekday() > 4:
+                    continue
+                written += 1
+                if rand.random() < malformed:
+                    csvfile.write('{},broken line\n'.format(user_id))
+                    continue
+                start = rand.randint(7 * 3600, 11 * 3600)
+                end = start + rand.randint(3600, 9 * 3600)
+                csvfile.write('{},{},{},{}\n'.format(
+                    user_id, day, _format_time(start), _format_time(end),
+                ))
+    return written
+
+
+def generate_xml(path, users=300, seed=0):
+    """
+    Writes intranet users XML with given amount of users.
+    """
+    rand = random.Random(seed)
+    with open(path, 'w') as xmlfile:
+        xmlfile.write(
+            '<?xml version="1.0" encoding="UTF-8" ?>\n<intranet>\n'
+            '    <server>\n'
+            '        <host>intranet.example.com</host>\n'
+            '        <port>443</port>\n'
+            '        <protocol>https</protocol>\n'
+            '    </server>\n'
+            '    <users>\n'
+        )
+        for user_id in xrange(users):
+            name = u'{} {}.'.format(
+                rand.choice(NAMES), rand.choice(u'ABCDEFGHIJKLŁMNOPRSŚTWZŻ')
+            )
+            xmlfile.write(
+                u'        <user id="{0}">\n'
+                u'            <avatar>/api/images/users/{0}</avatar>\n'
+                u'            <name>{1}</name>\n'
+                u'        </user>\n'.format(user_id, name).encode('utf-8')
+            )
+        xmlfile.write('    </users>\n</intranet>\n')
+
+
+def _format_time(seconds):
+    """
+    Formats seconds since midnight as 'HH:MM:SS'.
+    """
+    return '{:02d}:{:02d}:{:02d}'.format(
+        seconds // 3600, seconds // 60 % 60, seconds % 60
+    )
+
+
+def _parse_strict(csvfile):
+    """
+    Parses presence CSV with csv module and strptime only.
+    """
+    for i, row in enumerate(csv.reader(csvfile)):
+        utils.parse_presence_row(row, i)
+
+
+def _parse_fast(csvfile):
+    """
+    Parses presence CSV with fixed width fast path.
+    """
+    for _ in utils.read_presence_csv(csvfile):
+        pass
+
+
+def bench_csv_ingest(path, rows):
+    """
+    Returns rows per second of strict and fast CSV parsing.
+    """
+    result = {}
+    for name, parse in (('strict', _parse_strict), ('fast', _parse_fast)):
+        with open(path, 'r') as csvfile:
+            started = time.time()
+            parse(csvfile)
+            result[name] = rows / (time.time() - started)
+    return result
+
+
+def bench_parallel_ingest(path, rows, workers):
+    """
+    Returns rows per second of loading store serially and in parallel.
+
+    Parallel loading uses process pool started with utils.start_pool.
+    """
+    result = {}
+    for name, count in (('serial', 1), ('parallel', workers)):
+        started = time.time()
+        utils.load_presence_csv(path, count)
+        result[name] = rows / (time.time() - started)
+    return result
+
+
+def percentile(values, fraction):
+    """
+    Returns value of sorted values below which given fraction of them lie.
+    """
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+def timings(function, repeat):
+    """
+    Calls function repeat times, returns p50 and p99 latency in seconds.
+    """
+    durations = []
+    for _ in xrange(repeat):
+        started = time.time()
+        function()
+        durations.append(time.time() - started)
+    durations.sort()
+    return {
+        'p50': percentile(durations, 0.5),
+        'p99': percentile(durations, 0.99),
+    }
+
+
+def bench_loaders(rows):
+    """
+    Times cold get_data and get_data_xml calls.
+    """
+    result = {}
+    for name, loader in (('get_data', utils.get_data),
+                         ('get_data_xml', utils.get_data_xml)):
+        utils.clear_cache()
+        started = time.time()
+        loader()
+        result[name] = {'seconds': time.time() - started}
+    result['get_data']['rows_per_s'] = rows / result['get_data']['seconds']
+    return result
+
+
+def bench_aggregators(repeat):
+    """
+    Times utils aggregators, every call takes entries of next user.
+    """
+    data = utils.get_data()
+    users = [data[user_id] for user_id in data]
+    first, last = date(2011, 1, 1), date(2011, 6, 30)
+    aggregators = (
+        ('group_by_weekday', utils.group_by_weekday),
+        ('range_stats', utils.range_stats),
+        ('range_stats_dates',
+         lambda items: utils.range_stats(items, first, last)),
+        ('total_by_weekday',
+         lambda items: utils.total_by_weekday(utils.range_stats(items))),
+        ('mean_by_weekday',
+         lambda items: utils.mean_by_weekday(utils.range_stats(items))),
+        ('mean_by_month',
+         lambda items: utils.mean_by_month(utils.range_stats(items))),
+        ('mean_time_of_presence',
+         lambda items: utils.mean_time_of_presence(utils.range_stats(items))),
+    )
+    result = {}
+    for name, aggregator in aggregators:
+        calls = iter(xrange(repeat))
+        result[name] = timings(
+            lambda aggregator=aggregator, calls=calls: aggregator(
+                users[next(calls) % len(users)]
+            ),
+            repeat
+        )
+    result['company_stats'] = timings(
+        lambda: utils.company_stats(data, first, last), repeat
+    )
+    return result
+
+
+def bench_views(users, repeat):
+    """
+    Times API views through test client, requests cycle through users.
+
+    Response cache is cleared before every request, so views are rendered
+    each time.
+    """
+    client = app.test_client()
+    result = {}
+    for name, url in VIEWS:
+        urls = [url.format(user=index % users) for index in xrange(repeat)]
+        for url in urls[:1]:
+            response = client.get(url)
+            if response.status_code != 200:
+                raise AssertionError(
+                    '{} returned {}'.format(url, response.status_code)
+                )
+        requests = iter(urls)
+        result[name] = timings(
+            lambda requests=requests: (
+                utils.CACHE['jsonify'].clear(),
+                client.get(next(requests)).get_data(),
+            ),
+            repeat
+        )
+    return result
+
+
+def run_suite(sizes, years, malformed, repeat, workers, directory,
+              ingest_sizes=()):
+    """
+    Runs all benchmarks for every amount of users in sizes.
+
+    Ingest sizes run only ingest benchmarks, so views aren't timed on
+    multi-million row files. Sizes run from the smallest one, so peak
+    memory of every size is the peak of all sizes run so far.
+    """
+    results = {}
+    config = dict(app.config)
+    if workers > 1:
+        utils.start_pool(workers)
+    try:
+        for users in sorted(set(sizes) | set(ingest_sizes)):
+            csv_path = os.path.join(directory, 'presence.csv')
+            xml_path = os.path.join(directory, 'users.xml')
+            rows = generate_csv(csv_path, users, years, malformed)
+            generate_xml(xml_path, users)
+            app.config.update({
+                'DATA_CSV': csv_path,
+                'DATA_XML': xml_path,
+                'DATA_SNAPSHOT': None,
+                'DATA_SNAPSHOT_SHARED': False,
+                'RELOAD_ON_CHANGE': False,
+                'DATA_CSV_WORKERS': workers,
+            })
+            result = {'rows': rows}
+            result['ingest'] = bench_csv_ingest(csv_path, rows)
+            result['ingest'].update(
+                bench_parallel_ingest(csv_path, rows, workers)
+            )
+            if users in sizes:
+                result['loaders'] = bench_loaders(rows)
+                result['aggregators'] = bench_aggregators(repeat)
+                result['views'] = bench_views(users, repeat)
+            result['peak_rss_kb'] = resource.getrusage(
+                resource.RUSAGE_SELF
+            ).ru_maxrss
+            results[str(users)] = result
+            utils.clear_cache()
+            gc.collect()
+    finally:
+        utils.stop_pool()
+        app.config.clear()
+        app.config.update(config)
+        utils.clear_cache()
+    return results
+
+
+def flatten(result, prefix=''):
+    """
+    Turns nested results into {'size.group.name.metric': value} dict.
+    """
+    flat = {}
+    for key, value in result.iteritems():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + '.'))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns (name, baseline, current) of metrics worse than in baseline.
+
+    Latencies and memory regress when they grow, rates when they drop,
+    by more than tolerance fraction.
+    """
+    current, previous = flatten(results), flatten(baseline)
+    regressions = []
+    for name in sorted(set(current) & set(previous)):
+        old, new = previous[name], current[name]
+        if name.endswith('.rows') or not old:
+            continue
+        if name.rsplit('.', 1)[-1] in LATENCIES:
+            worse = new > old * (1 + tolerance)
+        else:
+            worse = new < old * (1 - tolerance)
+        if worse:
+            regressions.append((name, old, new))
+    return regressions
+
+
+def report(results):
+    """
+    Prints results as readable table.
+    """
+    for size in sorted(results, key=int):
+        result = results[size]
+        print 'Users: {}, rows: {:,}, peak RSS: {:,} kB'.format(
+            size, result['rows'], result['peak_rss_kb']
+        )
+        print '  ingest (rows/s):'
+        for name in ('strict', 'fast', 'serial', 'parallel'):
+            print '    {:<24}{:>14,.0f}'.format(name, result['ingest'][name])
+        if 'loaders' not in result:
+            continue
+        print '  loaders:'
+        for name, value in sorted(result['loaders'].iteritems()):
+            print '    {:<24}{:>11.1f} ms'.format(
+                name, value['seconds'] * 1000
+            )
+        print '    {:<24}{:>14,.0f}'.format(
+            'get_data rows/s', result['loaders']['get_data']['rows_per_s']
+        )
+        for group in ('aggregators', 'views'):
+            print '  {} (p50 / p99 ms):'.format(group)
+            for name, value in sorted(result[group].iteritems()):
+                print '    {:<24}{:>11.3f} / {:.3f}'.format(
+                    name, value['p50'] * 1000, value['p99'] * 1000
+                )
+
+
+def run():
+    """
+    Runs benchmark suite on generated data.
+    """
+    parser = argparse.ArgumentParser(description=run.__doc__)
+    parser.add_argument(
+        '--users', default='10,100,300',
+        help='comma separated amounts of users, suite runs for every one'
+    )
+    parser.add_argument(
+        '--ingest-users', default='3000',
+        help='comma separated amounts of users, only ingest runs for them'
+    )
+    parser.add_argument('--years', type=int, default=3)
+    parser.add_argument('--malformed', type=float, default=0.001)
+    parser.add_argument('--repeat', type=int, default=100)
+    parser.add_argument('--workers', type=int, default=cpu_count())
+    parser.add_argument('--save', help='write results to JSON file')
+    parser.add_argument('--baseline', help='compare with saved results')
+    parser.add_argument(
+        '--tolerance', type=float, default=0.2,
+        help='allowed fraction of regression against baseline'
+    )
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        results = run_suite(
+            [int(users) for users in args.users.split(',')],
+            args.years, args.malformed, args.repeat, args.workers, directory,
+            [int(users) for users in args.ingest_users.split(',') if users]
+        )
+    finally:
+        shutil.rmtree(directory)
+    report(results)
+
+    if args.save:
+        with open(args.save, 'w') as result_file:
+            json.dump(results, result_file, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(
+                results, json.load(baseline_file), args.tolerance
+            )
+        for name, old, new in regressions:
+            print 'REGRESSION {}: {:.6g} -> {:.6g}'.format(name, old, new)
+        if regressions:
+            sys.exit(1)
+        print 'No regressions against {}'.format(args.baseline)
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+Request and stage timing exposed in Prometheus text format.
+
+Timing is enabled with METRICS config option. Disabled timers only check
+the option, they don't read clock nor take locks.
+"""
+from functools import wraps
+from threading import Lock
+from time import time
+
+from flask import g, request
+
+from presence_analyzer.main import app
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Summary(object):
+    """
+    Count and sum of observed values by label values.
+    """
+
+    def __init__(self, name, description, labels):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values = {}
+        self.lock = Lock()
+
+    def observe(self, labels, value):
+        """
+        Adds value observed for given label values.
+        """
+        with self.lock:
+            observed = self.values.get(labels)
+            if observed is None:
+                observed = self.values[labels] = [0, 0.0]
+            observed[0] += 1
+            observed[1] += value
+
+    def clear(self):
+        """
+        Removes all observed values.
+        """
+        with self.lock:
+            self.values.clear()
+
+    def render(self):
+        """
+        Returns lines of summary in text format.
+        """
+        lines = [
+            '# HELP {} {}'.format(self.name, self.description),
+            '# TYPE {} summary'.format(self.name),
+        ]
+        with self.lock:
+            values = sorted(self.values.items())
+        for labels, (count, total) in values:
+            labels = format_labels(zip(self.labels, labels))
+            lines.append('{}_count{} {}'.format(
+                self.name, labels, format_value(count)
+            ))
+            lines.append('{}_sum{} {}'.format(
+                self.name, labels, format_value(total)
+            ))
+        return lines
+
+
+REQUESTS = Summary(
+    'presence_request_seconds',
+    'Time spent handling requests.',
+    ('endpoint', 'method', 'status'),
+)
+
+STAGES = Summary(
+    'presence_stage_seconds',
+    'Time spent in loaders, aggregators and JSON encoding.',
+    ('stage',),
+)
+
+# counters of LRUCache.stats() with their metric types
+CACHE_METRICS = (
+    ('hits', 'counter', 'Cache lookups served from cache.'),
+    ('misses', 'counter', 'Cache lookups which had to load value.'),
+    ('loads', 'counter', 'Values loaded into cache.'),
+    ('load_time', 'counter', 'Seconds spent loading values.'),
+    ('size', 'gauge', 'Entries, or their weight, held in cache.'),
+)
+
+
+def enabled():
+    """
+    Tells if metrics are collected.
+    """
+    return app.config.get('METRICS', False)
+
+
+class _StageTimer(object):
+    """
+    Context manager observing its duration in STAGES.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.started = None
+
+    def __enter__(self):
+        self.started = time()
+
+    def __exit__(self, *exc_info):
+        STAGES.observe((self.name,), time() - self.started)
+
+
+class _NullTimer(object):
+    """
+    Context manager doing nothing, used when metrics are disabled.
+    """
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_TIMER = _NullTimer()
+
+
+def stage(name):
+    """
+    Returns context manager timing stage with given name.
+    """
+    if not enabled():
+        return NULL_TIMER
+    return _StageTimer(name)
+
+
+def timed(name):
+    """
+    Decorator timing every call of function as stage with given name.
+    """
+    def _timed(function):  # pylint: disable=missing-docstring
+        @wraps(function)
+        def __timed(*args, **kwargs):  # pylint: disable=missing-docstring
+            if not enabled():
+                return function(*args, **kwargs)
+            with _StageTimer(name):
+                return function(*args, **kwargs)
+        return __timed
+    return _timed
+
+
+@app.before_request
+def start_request():
+    """
+    Remembers when request started.
+    """
+    if enabled():
+        g.metrics_started = time()
+
+
+@app.after_request
+def finish_request(response):
+    """
+    Observes request duration by endpoint, method and status.
+
+    Streamed responses are timed until their body starts being sent.
+    """
+    started = getattr(g, 'metrics_started', None)
+    if started is not None:
+        REQUESTS.observe(
+            (request.endpoint or '', request.method,
+             str(response.status_code)),
+            time() - started
+        )
+    return response
+
+
+def format_labels(labels):
+    """
+    Formats (name, value) pairs as labels of metric line.
+    """
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(
+            name,
+            value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n')
+        )
+        for name, value in labels
+    ))
+
+
+def format_value(value):
+    """
+    Formats number as value of metric line.
+    """
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def render(caches):
+    """
+    Returns all metrics in Prometheus text format.
+
+    Caches are LRUCache objects by name, their counters are read only
+    when rendering.
+    """
+    lines = REQUESTS.render() + STAGES.render()
+    stats = sorted((name, cache.stats()) for name, cache in caches.items())
+    for key, metric_type, description in CACHE_METRICS:
+        name = 'presence_cache_{}{}'.format(
+            key, '_total' if metric_type == 'counter' else ''
+        )
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} {}'.format(name, metric_type))
+        for cache, values in stats:
+            lines.append('{}{} {}'.format(
+                name, format_labels([('cache', cache)]),
+                format_value(values[key])
+            ))
+    return '\n'.join(lines) + '\n'
+
+
+def clear():
+    """
+    Removes all observed timings.
+    """
+    REQUESTS.clear()
+    STAGES.clear()
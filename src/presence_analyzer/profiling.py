@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+On-demand profiling of views.
+
+Views are profiled with cProfile when they are sampled, PROFILE_SAMPLE_RATE
+config option is the fraction of requests to profile, or in debug mode when
+'_profile=1' query parameter is given. Stats are aggregated by endpoint.
+
+Profiled requests set g.profiled, @jsonify doesn't answer them from the
+response cache nor with 304, so the view itself is profiled.
+"""
+import cProfile
+import marshal
+import pstats
+import random
+from functools import wraps
+from StringIO import StringIO
+from threading import Lock
+
+from flask import g, request
+
+from presence_analyzer.main import app
+
+
+# aggregated pstats.Stats and amount of profiled requests by endpoint
+PROFILES = {}
+
+LOCK = Lock()
+
+# views serving profiles, they aren't profiled themselves
+EXCLUDED = ('profile_view',)
+
+
+def enabled():
+    """
+    Tells if profiling can be requested.
+    """
+    return app.debug or app.config.get('PROFILE_SAMPLE_RATE', 0) > 0
+
+
+def install(application):
+    """
+    Wraps view functions of application with profiler.
+    """
+    for endpoint, view in application.view_functions.items():
+        if endpoint not in EXCLUDED and not hasattr(view, 'endpoint'):
+            application.view_functions[endpoint] = profiled(endpoint, view)
+
+
+def profiled(endpoint, view):
+    """
+    Returns view which runs under profiler for sampled requests.
+    """
+    @wraps(view)
+    def _profiled(*args, **kwargs):  # pylint: disable=missing-docstring
+        if not sampled():
+            return view(*args, **kwargs)
+        g.profiled = True
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(view, *args, **kwargs)
+        finally:
+            record(endpoint, profiler)
+    _profiled.endpoint = endpoint
+    return _profiled
+
+
+def sampled():
+    """
+    Tells if current request should be profiled.
+    """
+    if app.debug and request.args.get('_profile') == '1':
+        return True
+    rate = app.config.get('PROFILE_SAMPLE_RATE', 0)
+    return rate > 0 and random.random() < rate
+
+
+def record(endpoint, profiler):
+    """
+    Adds stats of profiler to stats of endpoint.
+    """
+    with LOCK:
+        profile = PROFILES.get(endpoint)
+        if profile is None:
+            PROFILES[endpoint] = [pstats.Stats(profiler), 1]
+        else:
+            profile[0].add(profiler)
+            profile[1] += 1
+
+
+def summary(endpoint, sort='cumulative', limit=30):
+    """
+    Returns top limit functions of endpoint stats as text.
+
+    Raises KeyError for endpoints without stats and unknown sort keys.
+    """
+    output = StringIO()
+    with LOCK:
+        stats, requests = PROFILES[endpoint]
+        if sort not in stats.get_sort_arg_defs():
+            raise KeyError(sort)
+        output.write('{} profiled requests\n'.format(requests))
+        stats.stream = output
+        stats.sort_stats(sort).print_stats(limit)
+    return output.getvalue()
+
+
+def dump(endpoint):
+    """
+    Returns endpoint stats in pstats file format.
+
+    Raises KeyError for endpoints without stats.
+    """
+    with LOCK:
+        return marshal.dumps(PROFILES[endpoint][0].stats)
+
+
+def counts():
+    """
+    Returns amounts of profiled requests by endpoint.
+    """
+    with LOCK:
+        return dict(
+            (endpoint, requests)
+            for endpoint, (_, requests) in PROFILES.iteritems()
+        )
+
+
+def clear():
+    """
+    Removes all collected stats.
+    """
+    with LOCK:
+        PROFILES.clear()
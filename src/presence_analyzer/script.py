@@ -2,11 +2,17 @@
 """Startup utilities"""
 # pylint:skip-file
 
+import errno
 import os
+import signal
+import socket
 import sys
+import traceback
+from ConfigParser import RawConfigParser
 from functools import partial
+from multiprocessing import cpu_count
+from time import sleep, time
 
-import paste.script.command
 import werkzeug.script
 
 etc = partial(os.path.join, 'parts', 'etc')
@@ -25,14 +31,34 @@ abspath = partial(os.path.join, _buildout_path)
 del _buildout_path
 
 
-# bin/paster serve parts/etc/deploy.ini
-def make_app(global_conf={}, config=DEPLOY_CFG, debug=False):
+def load_config(config=DEPLOY_CFG, debug=False):
+    """
+    Configures the application without starting background work.
+    """
     from presence_analyzer import app
     app.config.from_pyfile(abspath(config))
     app.debug = debug
     return app
 
 
+# bin/paster serve parts/etc/deploy.ini
+def make_app(global_conf={}, config=DEPLOY_CFG, debug=False):
+    app = load_config(config, debug)
+    if debug or app.config.get('PROFILE_SAMPLE_RATE'):
+        from presence_analyzer import profiling
+        profiling.install(app)
+    from presence_analyzer import utils
+    if app.config.get('DATA_CSV_WORKERS', 1) > 1:
+        # before any thread is started
+        utils.start_pool(app.config['DATA_CSV_WORKERS'])
+    if app.config.get('DATA_REFRESH_INTERVAL'):
+        utils.start_refresher(app.config['DATA_REFRESH_INTERVAL'])
+    if app.config.get('WARM_UP'):
+        from presence_analyzer import warmup
+        warmup.start(background=app.config['WARM_UP'] == 'background')
+    return app
+
+
 # bin/paster serve parts/etc/debug.ini
 def make_debug(global_conf={}, **conf):
     from werkzeug.debug import DebuggedApplication
@@ -79,15 +105,201 @@ def _serve(action, debug=False, dry_run=False):
         ]
     sys.argv = argv[:2] + [abspath(config)] + argv[3:]
     # Run the 'paster' command
+    import paste.script.command
     paste.script.command.run()
 
 
+ENGINES = ('paste', 'prefork', 'gevent')
+
+# worker exiting sooner after start failed to start
+RESPAWN_MIN_UPTIME = 1.0
+
+# delay before replacing worker which failed to start, doubles every time
+RESPAWN_BACKOFF = 0.5
+
+# consecutive workers failing to start stop serving
+RESPAWN_MAX_FAILURES = 5
+
+
+def _serve_with(engine, action, debug, processes, dry_run):
+    """
+    Serve with paster or, for other engines, from pre-forked processes.
+    """
+    if engine not in ENGINES:
+        raise SystemExit('Unknown engine {}, use one of: {}'.format(
+            engine, ', '.join(ENGINES)
+        ))
+    if engine == 'paste':
+        _serve(action, debug=debug, dry_run=dry_run)
+    elif action not in ('start', '', 'fg', 'foreground'):
+        raise SystemExit('{} engine serves only in foreground'.format(engine))
+    else:
+        _serve_forked(engine, debug, processes, dry_run)
+
+
+def _serve_forked(engine, debug=False, processes=0, dry_run=False):
+    """
+    Serve the application from pre-forked processes sharing one socket.
+
+    Data is loaded and warmed up before forking, so workers start with hot
+    caches and share their memory pages. 'prefork' engine runs threaded
+    werkzeug server in every process, 'gevent' engine runs gevent WSGI server.
+    """
+    config = RawConfigParser()
+    config.read(abspath(DEBUG_INI if debug else DEPLOY_INI))
+    host = config.get('server:main', 'host')
+    port = config.getint('server:main', 'port')
+    processes = processes or cpu_count()
+    print '{} engine, {} processes on {}:{}'.format(
+        engine, processes, host, port
+    )
+    if dry_run:
+        return
+
+    if engine == 'gevent':
+        try:
+            import gevent.pywsgi
+        except ImportError:
+            raise SystemExit('gevent engine requires gevent package')
+        serve = _serve_gevent
+    else:
+        serve = _serve_werkzeug
+
+    app = make_app(config=DEBUG_CFG if debug else DEPLOY_CFG, debug=debug)
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(128)
+
+    from presence_analyzer import utils, warmup
+    if not app.config.get('WARM_UP'):
+        warmup.start()
+    warmup.DONE.wait()
+    if not warmup.ready():
+        raise SystemExit('Warm-up failed, see log')
+    # no thread may hold locks while forking, workers start own refresher
+    # and process pool
+    utils.stop_refresher()
+    utils.stop_pool()
+    _prefork(partial(serve, app, listener), processes)
+
+
+def _serve_werkzeug(app, listener):
+    """
+    Serve app on listening socket with threaded werkzeug server.
+    """
+    from werkzeug.serving import make_server
+    server = make_server(
+        listener.getsockname()[0], 0, app, threaded=True,
+        fd=listener.fileno()
+    )
+    server.serve_forever()
+
+
+def _serve_gevent(app, listener):
+    """
+    Serve app on listening socket with gevent WSGI server.
+
+    Modules aren't monkey-patched, views run to completion one at a time
+    and gevent multiplexes connections waiting for requests and responses.
+    """
+    from gevent import socket as gevent_socket
+    from gevent.pywsgi import WSGIServer
+    WSGIServer(gevent_socket.socket(_sock=listener._sock), app).serve_forever()
+
+
+def _prefork(serve, processes):
+    """
+    Runs serve in given amount of child processes until terminated.
+
+    Children which exit are replaced, SIGTERM or SIGINT stops all of them.
+    Children exiting right after start are replaced with growing delay,
+    after RESPAWN_MAX_FAILURES of them in a row serving stops.
+    """
+    children = {}
+    stopping = []
+
+    def spawn():
+        pid = os.fork()
+        if pid:
+            children[pid] = time()
+            return
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        status = 0
+        try:
+            _after_fork()
+            serve()
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        finally:
+            os._exit(status)
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    handlers = dict(
+        (signum, signal.signal(signum, stop))
+        for signum in (signal.SIGTERM, signal.SIGINT)
+    )
+    failures = 0
+    try:
+        for _ in range(processes):
+            spawn()
+        while children:
+            try:
+                pid, _ = os.wait()
+            except OSError as error:
+                if error.errno == errno.EINTR:
+                    continue
+                raise
+            started = children.pop(pid)
+            if stopping:
+                continue
+            if time() - started < RESPAWN_MIN_UPTIME:
+                failures += 1
+            else:
+                failures = 0
+            if failures >= RESPAWN_MAX_FAILURES:
+                stop(None, None)
+                continue
+            if failures:
+                sleep(RESPAWN_BACKOFF * 2 ** (failures - 1))
+                if stopping:
+                    continue
+            spawn()
+    finally:
+        for signum, handler in handlers.iteritems():
+            signal.signal(signum, handler)
+    if failures >= RESPAWN_MAX_FAILURES:
+        raise SystemExit('Workers exit right after start, stopped serving')
+
+
+def _after_fork():
+    """
+    Starts CSV process pool and background data refresher in worker,
+    threads don't survive fork.
+    """
+    from presence_analyzer import app, utils
+    if app.config.get('DATA_CSV_WORKERS', 1) > 1:
+        utils.start_pool(app.config['DATA_CSV_WORKERS'])
+    if app.config.get('DATA_REFRESH_INTERVAL'):
+        utils.start_refresher(app.config['DATA_REFRESH_INTERVAL'])
+
+
 # bin/flask-ctl ...
 def run():
     action_shell = werkzeug.script.make_shell(make_shell, make_shell.__doc__)
 
     # bin/flask-ctl serve [fg|start|stop|restart|status]
-    def action_serve(action=('a', 'start'), dry_run=False):
+    def action_serve(action=('a', 'start'), engine=('e', 'paste'),
+                     processes=('p', 0), dry_run=False):
         """Serve the application.
 
         This command serves a web application that uses a paste.deploy
@@ -95,16 +307,20 @@ def run():
 
         Options:
          - 'action' is one of [fg|start|stop|restart|status]
+         - '--engine' is one of [paste|prefork|gevent], other engines than
+           paste serve in foreground from pre-forked processes
+         - '--processes' amount of pre-forked processes, CPU count by default
          - '--dry-run' print the paster command and exit
         """
-        _serve(action, debug=False, dry_run=dry_run)
+        _serve_with(engine, action, False, processes, dry_run)
 
     # bin/flask-ctl debug [fg|start|stop|restart|status]
-    def action_debug(action=('a', 'start'), dry_run=False):
+    def action_debug(action=('a', 'start'), engine=('e', 'paste'),
+                     processes=('p', 0), dry_run=False):
         """
         Serve the debugging application.
         """
-        _serve(action, debug=True, dry_run=dry_run)
+        _serve_with(engine, action, True, processes, dry_run)
 
     # bin/flask-ctl status
     def action_status(dry_run=False):
@@ -131,3 +347,23 @@ def download_xml():
 
     url = 'http://sargo.bolt.stxnext.pl/users.xml'
     urllib.urlretrieve(url, 'runtime/data/users.xml')
+
+
+def compile_snapshot():
+    """
+    Compile presence CSV and users XML into binary data snapshot.
+    """
+    from presence_analyzer import utils
+    from presence_analyzer.snapshot import write_snapshot
+
+    app = load_config(DEPLOY_CFG)
+    # snapshot is compiled from the source files, never from itself
+    app.config['DATA_SNAPSHOT_SHARED'] = False
+    if app.config.get('DATA_CSV_WORKERS', 1) > 1:
+        utils.start_pool(app.config['DATA_CSV_WORKERS'])
+    try:
+        path = app.config['DATA_SNAPSHOT']
+        write_snapshot(path, utils.get_data(), utils.get_data_xml())
+    finally:
+        utils.stop_pool()
+    print 'Snapshot written to {}'.format(path)
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+Binary snapshot of presence and users data.
+
+Snapshot file layout, all numbers little-endian:
+ - header: magic, format version, amount of presence entries, store users,
+   table users and length of JSON metadata (sources of data, server),
+ - metadata,
+ - store index: user id, begin and end offset and aggregates of every user,
+ - store columns: users, dates, starts and ends as 32-bit integers,
+ - table index: user id, name length and avatar length of every user,
+ - utf-8 encoded names and avatar paths.
+"""
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from array import array
+from contextlib import contextmanager
+
+from presence_analyzer.store import PresenceStore, UserTable
+
+
+MAGIC = b'PRESENCE'
+
+FORMAT_VERSION = 1
+
+HEADER = struct.Struct('<8sHIIII')
+
+# aggregates of PresenceStore with their lengths, in snapshot order
+AGGREGATES = (
+    ('weekday_total', 7),
+    ('weekday_count', 7),
+    ('weekday_start', 7),
+    ('weekday_end', 7),
+    ('month_total', 12),
+    ('month_count', 12),
+)
+
+STORE_USER = struct.Struct(
+    '<iII{}q'.format(sum(length for _, length in AGGREGATES))
+)
+
+TABLE_USER = struct.Struct('<iII')
+
+ITEM = struct.Struct('<i')
+
+# amount of values read at once when iterating over mapped column
+ITER_CHUNK = 64 * 1024
+
+COLUMNS = ('users', 'dates', 'starts', 'ends')
+
+
+def write_snapshot(path, store, table):
+    """
+    Writes store and table to snapshot file.
+
+    File is written next to path and renamed, so readers never see
+    partially written snapshot.
+    """
+    meta = json.dumps({
+        'store': store.source,
+        'table': table.source,
+        'server': table.server,
+    })
+    names = [name.encode('utf-8') for name in table.names]
+    avatars = [avatar.encode('utf-8') for avatar in table.avatars]
+
+    handle, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp'
+    )
+    try:
+        with os.fdopen(handle, 'wb') as snapshot:
+            snapshot.write(HEADER.pack(
+                MAGIC, FORMAT_VERSION, len(store.users), len(store.offsets),
+                len(table), len(meta)
+            ))
+            snapshot.write(meta)
+            for user_id in sorted(store.offsets):
+                aggregates = store.aggregates[user_id]
+                values = []
+                for name, _ in AGGREGATES:
+                    values.extend(aggregates[name])
+                snapshot.write(STORE_USER.pack(
+                    user_id, *(store.offsets[user_id] + tuple(values))
+                ))
+            for column in COLUMNS:
+                snapshot.write(_little_endian(getattr(store, column)))
+            for user_id, name, avatar in zip(table.ids, names, avatars):
+                snapshot.write(
+                    TABLE_USER.pack(user_id, len(name), len(avatar))
+                )
+            for name, avatar in zip(names, avatars):
+                snapshot.write(name)
+                snapshot.write(avatar)
+        # mkstemp creates file readable only by its owner
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(temp_path, 0o644 & ~umask)
+        os.rename(temp_path, path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+
+def read_presence(path, shared=False):
+    """
+    Reads PresenceStore from snapshot file.
+
+    Shared store columns aren't copied, they read the memory-mapped file
+    directly, so its pages are shared by all processes mapping it.
+    Description of mapped file is kept in store mapped_source.
+    """
+    with _mapped(path, shared) as (snapshot, header, meta, offset, source):
+        _, _, rows, store_users, _, _ = header
+
+        offsets, aggregates = {}, {}
+        for _ in xrange(store_users):
+            values = STORE_USER.unpack_from(snapshot, offset)
+            offset += STORE_USER.size
+            user_id = values[0]
+            offsets[user_id] = values[1:3]
+            aggregates[user_id] = {}
+            position = 3
+            for name, length in AGGREGATES:
+                aggregates[user_id][name] = list(
+                    values[position:position + length]
+                )
+                position += length
+
+        columns = []
+        for _ in COLUMNS:
+            column = MappedColumn(snapshot, offset, rows)
+            columns.append(column if shared else column[:])
+            offset += rows * 4
+
+    store = PresenceStore(*columns, aggregates=aggregates, offsets=offsets)
+    store.source = _decode_source(meta['store'])
+    if shared:
+        store.mapped_source = source
+    return store
+
+
+def read_users(path):
+    """
+    Reads UserTable from snapshot file.
+    """
+    with _mapped(path) as (snapshot, header, meta, offset, _):
+        _, _, rows, store_users, table_users, _ = header
+        offset += store_users * STORE_USER.size + len(COLUMNS) * rows * 4
+
+        records = []
+        for _ in xrange(table_users):
+            records.append(TABLE_USER.unpack_from(snapshot, offset))
+            offset += TABLE_USER.size
+
+        table = UserTable()
+        for user_id, name_length, avatar_length in records:
+            name = snapshot[offset:offset + name_length]
+            offset += name_length
+            avatar = snapshot[offset:offset + avatar_length]
+            offset += avatar_length
+            table.add(user_id, name.decode('utf-8'), avatar.decode('utf-8'))
+
+    table.server = meta['server']
+    table.source = _decode_source(meta['table'])
+    return table
+
+
+class MappedColumn(object):
+    """
+    Read-only column of little-endian 32-bit integers in mapped file.
+
+    Slices are copied into arrays, indexing reads single value.
+    """
+    typecode = 'i'
+
+    def __init__(self, mapping, offset, length):
+        self.mapping = mapping
+        self.offset = offset
+        self.length = length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.length)
+            if step != 1:
+                raise ValueError('Mapped column slices must be contiguous')
+            column = array(
+                'i',
+                self.mapping[
+                    self.offset + start * 4:self.offset + max(stop, start) * 4
+                ]
+            )
+            if sys.byteorder == 'big':
+                column.byteswap()
+            return column
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError('Mapped column index out of range')
+        return ITEM.unpack_from(self.mapping, self.offset + index * 4)[0]
+
+    def __iter__(self):
+        for start in xrange(0, self.length, ITER_CHUNK):
+            for value in self[start:start + ITER_CHUNK]:
+                yield value
+
+    def __len__(self):
+        return self.length
+
+    def tostring(self):
+        """
+        Returns column bytes in native byte order, like array.tostring.
+        """
+        return self[:].tostring()
+
+
+@contextmanager
+def _mapped(path, keep_open=False):
+    """
+    Maps snapshot file into memory and parses its header.
+
+    Raises ValueError for files which aren't snapshots of current format.
+    Mapping is closed on exit unless keep_open is set.
+    """
+    with open(path, 'rb') as snapshot_file:
+        stat = os.fstat(snapshot_file.fileno())
+        snapshot = mmap.mmap(
+            snapshot_file.fileno(), 0, access=mmap.ACCESS_READ
+        )
+    source = {
+        'path': path,
+        'inode': stat.st_ino,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+    }
+    try:
+        if len(snapshot) < HEADER.size:
+            raise ValueError('Snapshot {} is too short'.format(path))
+        header = HEADER.unpack_from(snapshot)
+        if header[:2] != (MAGIC, FORMAT_VERSION):
+            raise ValueError('Unsupported snapshot {}'.format(path))
+        offset = HEADER.size + header[-1]
+        meta = json.loads(snapshot[HEADER.size:offset])
+        yield snapshot, header, meta, offset, source
+    except Exception:
+        snapshot.close()
+        raise
+    if not keep_open:
+        snapshot.close()
+
+
+def _little_endian(column):
+    """
+    Returns bytes of integer array in little-endian order.
+    """
+    if sys.byteorder == 'big':
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column.tostring()
+
+
+def _decode_source(source):
+    """
+    Turns unicode strings of source loaded from JSON back into bytes.
+    """
+    return dict(
+        (key, value.encode('utf-8') if isinstance(value, unicode) else value)
+        for key, value in source.iteritems()
+    )
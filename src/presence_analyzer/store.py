@@ -0,0 +1,490 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar storage for presence data.
+"""
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Mapping
+from datetime import date, time
+from itertools import izip
+from operator import itemgetter
+
+
+def seconds_to_time(seconds):
+    """
+    Converts amount of seconds since midnight to datetime.time object.
+    """
+    return time(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class UserPresence(Mapping):
+    """
+    Read-only view of single user presence entries.
+
+    Entries are a contiguous slice of the store columns, sorted by date.
+    Mapping interface keeps compatibility with the old nested dict:
+    view[datetime.date] == {'start': datetime.time, 'end': datetime.time}
+    """
+
+    def __init__(self, store, user_id, begin, end):
+        self.store = store
+        self.user_id = user_id
+        self.begin = begin
+        self.end = end
+
+    @property
+    def dates(self):
+        """
+        Date ordinals of user entries.
+        """
+        return self.store.dates[self.begin:self.end]
+
+    @property
+    def starts(self):
+        """
+        Start times of user entries in seconds since midnight.
+        """
+        return self.store.starts[self.begin:self.end]
+
+    @property
+    def ends(self):
+        """
+        End times of user entries in seconds since midnight.
+        """
+        return self.store.ends[self.begin:self.end]
+
+    @property
+    def aggregates(self):
+        """
+        Aggregates of user entries, see PresenceStore.
+        """
+        return self.store.aggregates[self.user_id]
+
+    def rows(self):
+        """
+        Iterates over (date ordinal, start, end) tuples.
+        """
+        return izip(self.dates, self.starts, self.ends)
+
+    def __getitem__(self, day):
+        index = bisect_left(
+            self.store.dates, day.toordinal(), self.begin, self.end
+        )
+        if index == self.end or self.store.dates[index] != day.toordinal():
+            raise KeyError(day)
+        return {
+            'start': seconds_to_time(self.store.starts[index]),
+            'end': seconds_to_time(self.store.ends[index]),
+        }
+
+    def __iter__(self):
+        return (date.fromordinal(ordinal) for ordinal in self.dates)
+
+    def __len__(self):
+        return self.end - self.begin
+
+
+class RunningSums(object):
+    """
+    Running sums of entry values grouped by weekday or month.
+
+    Entries are ordered by group and date, bounds hold offsets of every
+    group. Every array of sums holds sums of a column of values of all
+    preceding entries, so sums of any date range of group take two binary
+    searches and a subtraction. Amount of entries is the difference of
+    offsets. Sums are integers of given array typecode.
+    """
+
+    def __init__(self, dates, groups, group_of, columns, typecode='i'):
+        ordered = sorted(
+            xrange(len(dates)), key=lambda index: group_of(dates[index])
+        )
+        self.bounds = [0] * (groups + 1)
+        self.dates = array('i')
+        self.sums = [array(typecode, [0]) for _ in columns]
+        for index in ordered:
+            self.bounds[group_of(dates[index]) + 1] += 1
+            self.dates.append(dates[index])
+            for sums, column in izip(self.sums, columns):
+                sums.append(sums[-1] + column[index])
+        for group in xrange(groups):
+            self.bounds[group + 1] += self.bounds[group]
+
+    def between(self, first=None, last=None):
+        """
+        Returns list of counts followed by lists of sums of every column,
+        for every group of entries from first to last date ordinal
+        inclusive.
+        """
+        result = [[] for _ in xrange(len(self.sums) + 1)]
+        counts = result[0]
+        for group in xrange(len(self.bounds) - 1):
+            begin, end = self.bounds[group], self.bounds[group + 1]
+            if first is not None:
+                begin = bisect_left(self.dates, first, begin, end)
+            if last is not None:
+                end = bisect_right(self.dates, last, begin, end)
+            counts.append(end - begin)
+            for values, sums in izip(result[1:], self.sums):
+                values.append(sums[end] - sums[begin])
+        return result
+
+
+def sums_aggregates(weekdays, months):
+    """
+    Returns aggregates, see PresenceStore, of weekday counts, totals, starts
+    and ends lists and month counts and totals lists.
+    """
+    weekday_count, weekday_total, weekday_start, weekday_end = weekdays
+    month_count, month_total = months
+    return {
+        'weekday_total': weekday_total,
+        'weekday_count': weekday_count,
+        'weekday_start': weekday_start,
+        'weekday_end': weekday_end,
+        'month_total': month_total,
+        'month_count': month_count,
+    }
+
+
+class PresenceStore(Mapping):
+    """
+    Presence data kept in typed arrays sorted by user and date.
+
+    Every column holds one value per presence entry:
+     - users: user id,
+     - dates: date ordinal (datetime.date.toordinal()),
+     - starts, ends: seconds since midnight.
+
+    Entries of every user form a contiguous slice described by offsets.
+    Indexing the store with user id returns UserPresence view.
+
+    Aggregates hold per user sums computed once when store is created:
+     - weekday_total, weekday_count: presence seconds and entries by weekday,
+     - weekday_start, weekday_end: sums of start and end seconds by weekday,
+     - month_total, month_count: presence seconds and entries by month.
+
+    Month rankings hold (user_id, mean presence) pairs of all users sorted
+    from the longest mean presence, one list for every month. Users with
+    equal means are ordered by id.
+
+    Running holds weekday and month RunningSums of users, company holds
+    RunningSums of all entries. Loaders build both with build_running_sums,
+    other stores on first query. Merged stores keep running sums of users
+    without new rows.
+
+    Source describes the file store was loaded from, it is set by loaders.
+    Mapped source describes memory-mapped snapshot file of shared stores.
+    """
+
+    def __init__(self, users, dates, starts, ends, aggregates=None,
+                 offsets=None):
+        self.users = users
+        self.dates = dates
+        self.starts = starts
+        self.ends = ends
+        self.offsets = offsets
+        self.aggregates = {}
+        self.source = None
+        self.mapped_source = None
+        self.running = {}
+        self.company = None
+
+        if self.offsets is None:
+            self.offsets = {}
+            begin = 0
+            for index in xrange(1, len(users) + 1):
+                if index == len(users) or users[index] != users[begin]:
+                    self.offsets[users[begin]] = (begin, index)
+                    begin = index
+
+        months = {}
+        for user_id, (begin, end) in self.offsets.iteritems():
+            if aggregates is not None and user_id in aggregates:
+                self.aggregates[user_id] = aggregates[user_id]
+            else:
+                self.aggregates[user_id] = self.aggregate(begin, end, months)
+
+        self.month_rankings = []
+        for month in range(12):
+            means = []
+            for user_id in sorted(self.aggregates):
+                total = self.aggregates[user_id]['month_total'][month]
+                count = self.aggregates[user_id]['month_count'][month]
+                means.append((user_id, float(total) / count if count else 0))
+            means.sort(key=itemgetter(1), reverse=True)
+            self.month_rankings.append(means)
+
+    def aggregate(self, begin, end, months):
+        """
+        Computes aggregates of entries between begin and end offsets.
+
+        Months dict caches month (0-11) of date ordinal.
+        """
+        result = {
+            'weekday_total': [0] * 7,
+            'weekday_count': [0] * 7,
+            'weekday_start': [0] * 7,
+            'weekday_end': [0] * 7,
+            'month_total': [0] * 12,
+            'month_count': [0] * 12,
+        }
+        weekday_total = result['weekday_total']
+        weekday_count = result['weekday_count']
+        weekday_start = result['weekday_start']
+        weekday_end = result['weekday_end']
+        month_total = result['month_total']
+        month_count = result['month_count']
+        for ordinal, arrival, departure in izip(
+                self.dates[begin:end],
+                self.starts[begin:end],
+                self.ends[begin:end]):
+            weekday = (ordinal - 1) % 7
+            weekday_total[weekday] += departure - arrival
+            weekday_count[weekday] += 1
+            weekday_start[weekday] += arrival
+            weekday_end[weekday] += departure
+            month = months.get(ordinal)
+            if month is None:
+                month = months[ordinal] = date.fromordinal(ordinal).month - 1
+            month_total[month] += departure - arrival
+            month_count[month] += 1
+        return result
+
+    def running_sums(self, user_id):
+        """
+        Returns weekday and month RunningSums of user entries.
+
+        Weekday sums hold presence, start and end seconds, month sums only
+        presence seconds.
+        """
+        sums = self.running.get(user_id)
+        if sums is None:
+            begin, end = self.offsets[user_id]
+            dates = self.dates[begin:end]
+            starts, ends = self.starts[begin:end], self.ends[begin:end]
+            totals = array('i', [
+                departure - arrival
+                for arrival, departure in izip(starts, ends)
+            ])
+            sums = self.running[user_id] = self.running_sums_of(
+                dates, (totals, starts, ends), 1, 'i'
+            )
+        return sums
+
+    def build_running_sums(self):
+        """
+        Builds running sums of users which don't have them yet and
+        company-wide ones.
+        """
+        for user_id in self.offsets:
+            self.running_sums(user_id)
+        self.company_sums()
+        return self
+
+    def company_sums(self):
+        """
+        Returns weekday and month RunningSums of entries of all users.
+
+        Entries are summed by date in a single pass first, sums are built
+        from one row of entry count, presence, start and end seconds per
+        date. Company-wide sums exceed 32 bits, they are kept in longs.
+        """
+        if self.company is None:
+            days = {}
+            for ordinal, arrival, departure in izip(
+                    self.dates, self.starts, self.ends):
+                day = days.get(ordinal)
+                if day is None:
+                    day = days[ordinal] = [0, 0, 0, 0]
+                day[0] += 1
+                day[1] += departure - arrival
+                day[2] += arrival
+                day[3] += departure
+            dates = sorted(days)
+            columns = [
+                array('l', [days[ordinal][column] for ordinal in dates])
+                for column in xrange(4)
+            ]
+            self.company = self.running_sums_of(dates, columns, 2, 'l')
+        return self.company
+
+    @staticmethod
+    def running_sums_of(dates, columns, month_columns, typecode):
+        """
+        Builds weekday and month RunningSums of columns of entry values,
+        month sums hold only the first month_columns of them.
+        """
+        months = dict(
+            (ordinal, date.fromordinal(ordinal).month - 1)
+            for ordinal in set(dates)
+        )
+        return (
+            RunningSums(
+                dates, 7, lambda ordinal: (ordinal - 1) % 7, columns,
+                typecode
+            ),
+            RunningSums(
+                dates, 12, months.__getitem__, columns[:month_columns],
+                typecode
+            ),
+        )
+
+    def range_aggregates(self, user_id, first=None, last=None):
+        """
+        Returns aggregates of user entries from first to last date ordinal
+        inclusive, None leaves the range open.
+        """
+        if first is None and last is None:
+            return self.aggregates[user_id]
+        weekdays, months = self.running_sums(user_id)
+        return sums_aggregates(
+            weekdays.between(first, last), months.between(first, last)
+        )
+
+    def company_aggregates(self, first=None, last=None):
+        """
+        Returns aggregates of entries of all users from first to last date
+        ordinal inclusive, None leaves the range open.
+
+        Counts are sums of entry counts of dates, not amounts of dates.
+        """
+        weekdays, months = self.company_sums()
+        return sums_aggregates(
+            weekdays.between(first, last)[1:], months.between(first, last)[1:]
+        )
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Builds store from iterable of (user_id, ordinal, start, end) tuples.
+
+        Later entry wins when the same user and date occurs more than once.
+        """
+        days = {}
+        for user_id, ordinal, start, end in rows:
+            days.setdefault(user_id, {})[ordinal] = (start, end)
+
+        users, dates = array('i'), array('i')
+        starts, ends = array('i'), array('i')
+        for user_id in sorted(days):
+            user_days = days.pop(user_id)
+            for ordinal in sorted(user_days):
+                start, end = user_days[ordinal]
+                users.append(user_id)
+                dates.append(ordinal)
+                starts.append(start)
+                ends.append(end)
+
+        return cls(users, dates, starts, ends)
+
+    def merge(self, rows):
+        """
+        Returns new store with (user_id, ordinal, start, end) rows added.
+
+        Users without new rows are copied slice by slice and keep their
+        aggregates and running sums. Rows of other users are appended, or
+        merged by date if they aren't the newest.
+        """
+        days = {}
+        for user_id, ordinal, start, end in rows:
+            days.setdefault(user_id, {})[ordinal] = (start, end)
+
+        users, dates = array('i'), array('i')
+        starts, ends = array('i'), array('i')
+        aggregates = dict(
+            (user_id, self.aggregates[user_id])
+            for user_id in self.offsets if user_id not in days
+        )
+        for user_id in sorted(set(self.offsets) | set(days)):
+            begin, end = self.offsets.get(user_id, (0, 0))
+            new_days = days.get(user_id, {})
+            if begin < end and new_days and \
+                    min(new_days) <= self.dates[end - 1]:
+                # rows change old entries, merge whole user by date
+                new_days = dict(izip(
+                    self.dates[begin:end],
+                    izip(self.starts[begin:end], self.ends[begin:end])
+                ))
+                new_days.update(days[user_id])
+                begin = end
+            users.extend(self.users[begin:end])
+            dates.extend(self.dates[begin:end])
+            starts.extend(self.starts[begin:end])
+            ends.extend(self.ends[begin:end])
+            for ordinal in sorted(new_days):
+                users.append(user_id)
+                dates.append(ordinal)
+                starts.append(new_days[ordinal][0])
+                ends.append(new_days[ordinal][1])
+
+        merged = self.__class__(users, dates, starts, ends, aggregates)
+        merged.running = dict(
+            (user_id, sums) for user_id, sums in self.running.iteritems()
+            if user_id not in days
+        )
+        return merged
+
+    def __getitem__(self, user_id):
+        begin, end = self.offsets[user_id]
+        return UserPresence(self, user_id, begin, end)
+
+    def __contains__(self, user_id):
+        return user_id in self.offsets
+
+    def __iter__(self):
+        return iter(sorted(self.offsets))
+
+    def __len__(self):
+        return len(self.offsets)
+
+
+class UserTable(Mapping):
+    """
+    Users from the intranet XML kept in parallel lists.
+
+    Avatars are stored as paths, the server prefix is shared by all of them.
+    Mapping interface keeps compatibility with the old dict:
+    table[user_id] == {'avatar': 'scheme://server:port/path', 'name': name}
+
+    Sorted ids and source are set by loaders.
+    """
+
+    def __init__(self):
+        self.ids = array('i')
+        self.names = []
+        self.avatars = []
+        self.index = {}
+        self.server = ''
+        self.sorted_ids = ()
+        self.source = None
+
+    def add(self, user_id, name, avatar):
+        """
+        Adds user or replaces the one with the same id.
+        """
+        if user_id in self.index:
+            position = self.index[user_id]
+            self.names[position] = name
+            self.avatars[position] = avatar
+            return
+        self.index[user_id] = len(self.ids)
+        self.ids.append(user_id)
+        self.names.append(name)
+        self.avatars.append(avatar)
+
+    def __getitem__(self, user_id):
+        position = self.index[user_id]
+        return {
+            'avatar': self.server + self.avatars[position],
+            'name': self.names[position],
+        }
+
+    def __contains__(self, user_id):
+        return user_id in self.index
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
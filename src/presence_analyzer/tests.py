@@ -4,14 +4,24 @@ Presence analyzer unit tests.
 """
 from __future__ import unicode_literals
 
-import os.path
+import os
 import json
+import pstats
+import shutil
+import signal
+import sys
 import datetime
+import io
+import tempfile
+import threading
 import unittest
 
-from time import time as tm
+from time import sleep, time as tm
 
-from presence_analyzer import main, utils
+from presence_analyzer import (
+    benchmark, main, metrics, profiling, script, snapshot, utils, warmup
+)
+from presence_analyzer.store import PresenceStore, UserTable
 
 
 TEST_DATA_CSV = os.path.join(
@@ -40,7 +50,7 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
             }
         )
         self.client = main.app.test_client()
-        utils.CACHE = {}
+        utils.clear_cache()
 
     def tearDown(self):
         """
@@ -167,6 +177,37 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
             ]
         )
 
+    def test_api_date_range(self):
+        """
+        Test per user statistics limited to date range.
+        """
+        resp = self.client.get(
+            '/api/v1/presence_weekday/10?from=2013-09-11&to=2013-09-11'
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertListEqual(
+            json.loads(resp.data)[1:5],
+            [['Mon', 0], ['Tue', 0], ['Wed', 24465.0], ['Thu', 0]]
+        )
+        resp = self.client.get('/api/v1/mean_time_weekday/10?to=2013-09-10')
+        self.assertListEqual(
+            json.loads(resp.data)[1:4],
+            [['Tue', 30047.0], ['Wed', 0], ['Thu', 0]]
+        )
+        resp = self.client.get('/api/v1/presence_start_end/10?from=2014-01-01')
+        self.assertListEqual(
+            [value for _, value in json.loads(resp.data)],
+            [{'start': 0, 'end': 0}] * 7
+        )
+        resp = self.client.get(
+            '/api/v1/bulk/presence_weekday?user_id=10&from=2013-09-12'
+        )
+        self.assertEqual(json.loads(resp.data)['10'][4], ['Thu', 23705.0])
+
+        for query in ('from=2013-13-01', 'to=yesterday'):
+            resp = self.client.get('/api/v1/presence_weekday/10?' + query)
+            self.assertEqual(resp.status_code, 400)
+
     def test_api_presence_weekday_404(self):
         """
         Test api presence weekday view unexisting user.
@@ -195,6 +236,402 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
             ]
         )
 
+    def test_bulk_view(self):
+        """
+        Test api returning statistic for many users.
+        """
+        resp = self.client.get(
+            '/api/v1/bulk/presence_weekday?user_id=10&user_id=1'
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertItemsEqual(data.keys(), ['10', '1'])
+        self.assertIsNone(data['1'])
+        self.assertEqual(
+            data['10'],
+            json.loads(self.client.get('/api/v1/presence_weekday/10').data)
+        )
+
+        resp = self.client.get('/api/v1/bulk/mean_time_weekday')
+        data = json.loads(resp.data)
+        self.assertItemsEqual(data.keys(), ['10', '11'])
+        self.assertEqual(
+            data['11'],
+            json.loads(self.client.get('/api/v1/mean_time_weekday/11').data)
+        )
+
+    def test_bulk_view_streamed(self):
+        """
+        Test bulk response is streamed.
+        """
+        resp = self.client.get('/api/v1/bulk/presence_weekday')
+        self.assertTrue(resp.is_streamed)
+        self.assertItemsEqual(json.loads(resp.data).keys(), ['10', '11'])
+
+    def test_bulk_view_post(self):
+        """
+        Test api returning statistic for users given in request body.
+        """
+        resp = self.client.post(
+            '/api/v1/bulk/presence_start_end',
+            data=json.dumps({'user_id': [11]}),
+            content_type='application/json'
+        )
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertItemsEqual(data.keys(), ['11'])
+        self.assertEqual(
+            data['11'],
+            json.loads(self.client.get('/api/v1/presence_start_end/11').data)
+        )
+
+        for body in ({'user_id': ['x']}, {'user_id': '1011'},
+                     {'user_id': [1.5]}, {}, ['11']):
+            resp = self.client.post(
+                '/api/v1/bulk/presence_start_end',
+                data=json.dumps(body),
+                content_type='application/json'
+            )
+            self.assertEqual(resp.status_code, 400)
+        resp = self.client.post(
+            '/api/v1/bulk/presence_start_end',
+            data=json.dumps({'user_id': []}),
+            content_type='application/json'
+        )
+        self.assertEqual(json.loads(resp.data), {})
+        resp = self.client.get('/api/v1/bulk/users')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_bulk_view_invalid_user_id(self):
+        """
+        Test invalid user ids in query aren't ignored.
+        """
+        for query in ('user_id=abc', 'user_id=10&user_id=1x'):
+            resp = self.client.get('/api/v1/bulk/presence_weekday?' + query)
+            self.assertEqual(resp.status_code, 400)
+        resp = self.client.get('/api/v1/bulk/presence_weekday?user_id=10')
+        self.assertItemsEqual(json.loads(resp.data).keys(), ['10'])
+
+    def test_conditional_requests(self):
+        """
+        Test api views answer 304 when client has current data.
+        """
+        resp = self.client.get('/api/v1/presence_weekday/10')
+        self.assertEqual(resp.status_code, 200)
+        etag = resp.headers['ETag']
+        modified = resp.headers['Last-Modified']
+        self.assertIn('must-revalidate', resp.headers['Cache-Control'])
+
+        resp = self.client.get(
+            '/api/v1/presence_weekday/10',
+            headers={'If-None-Match': etag}
+        )
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, b'')
+        self.assertEqual(resp.headers['ETag'], etag)
+
+        resp = self.client.get(
+            '/api/v1/presence_weekday/10',
+            headers={'If-Modified-Since': modified}
+        )
+        self.assertEqual(resp.status_code, 304)
+
+        resp = self.client.get(
+            '/api/v1/presence_weekday/11',
+            headers={'If-None-Match': etag}
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+        resp = self.client.post(
+            '/api/v1/bulk/presence_weekday',
+            data=json.dumps({'user_id': [10]}),
+            content_type='application/json'
+        )
+        self.assertNotIn('ETag', resp.headers)
+
+    def test_conditional_requests_data_changed(self):
+        """
+        Test ETag changes when data is reloaded from changed file.
+        """
+        resp = self.client.get('/api/v1/months')
+        etag = resp.headers['ETag']
+        data = utils.get_data()
+        data.source = dict(data.source, size=data.source['size'] + 1)
+        resp = self.client.get(
+            '/api/v1/months',
+            headers={'If-None-Match': etag}
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+    def test_response_cache(self):
+        """
+        Test serialized responses are cached per path and data version.
+        """
+        responses = utils.CACHE['jsonify']
+        first = self.client.get('/api/v1/mean_time_weekday/10')
+        before = responses.stats()
+        second = self.client.get('/api/v1/mean_time_weekday/10')
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(responses.stats()['hits'], before['hits'] + 1)
+        self.assertEqual(responses.size, len(first.data))
+
+        self.client.get('/api/v1/mean_time_weekday/11')
+        self.assertEqual(len(responses.entries), 2)
+
+        data = utils.get_data()
+        data.source = dict(data.source, size=data.source['size'] + 1)
+        self.client.get('/api/v1/mean_time_weekday/11')
+        self.assertListEqual(
+            responses.entries.keys(), ['/api/v1/mean_time_weekday/11?']
+        )
+
+    def test_response_cache_version_race(self):
+        """
+        Test body of older snapshot isn't stored under newer version.
+        """
+        responses = utils.ResponseCache(1024)
+
+        def weigh(body):  # pylint: disable=missing-docstring
+            if body == 'old':
+                # newer snapshot stored while older body is being stored
+                responses.store('new', '/api/v1/months?', 'new')
+            return len(body)
+
+        responses.weigh = weigh
+        responses.store('old', '/api/v1/months?', 'old')
+        self.assertIsNone(responses.lookup('new', '/api/v1/months?'))
+        self.assertEqual(responses.lookup('old', '/api/v1/months?'), 'old')
+        self.assertEqual(responses.size, 3)
+
+    def test_response_cache_size(self):
+        """
+        Test cached responses are limited by their total size.
+        """
+        responses = utils.CACHE['jsonify']
+        self.addCleanup(main.app.config.pop, 'RESPONSE_CACHE_SIZE')
+        main.app.config['RESPONSE_CACHE_SIZE'] = 0
+        sizes = [
+            len(self.client.get('/api/v1/mean_time_weekday/10').data),
+            len(self.client.get('/api/v1/presence_weekday/10').data),
+        ]
+        self.assertEqual(len(responses.entries), 0)
+
+        main.app.config['RESPONSE_CACHE_SIZE'] = max(sizes)
+        self.client.get('/api/v1/mean_time_weekday/10')
+        self.client.get('/api/v1/presence_weekday/10')
+        self.assertListEqual(
+            responses.entries.keys(), ['/api/v1/presence_weekday/10?']
+        )
+
+    def test_aggregate_view(self):
+        """
+        Test statistics of all users together.
+        """
+        resp = self.client.get('/api/v1/aggregate/presence_weekday')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertListEqual(
+            data,
+            [
+                ['Weekday', 'Presence (s)'],
+                ['Mon', 24123],
+                ['Tue', 46611],
+                ['Wed', 49786],
+                ['Thu', 69673],
+                ['Fri', 6426],
+                ['Sat', 0],
+                ['Sun', 0],
+            ]
+        )
+
+        resp = self.client.get('/api/v1/aggregate/presence_month')
+        data = json.loads(resp.data)
+        self.assertListEqual(data[0], ['Month', 'Presence (s)'])
+        self.assertListEqual(data[9], ['September', 196619])
+        self.assertEqual(sum(total for _, total in data[1:]), 196619)
+
+        resp = self.client.get(
+            '/api/v1/aggregate/presence_start_end?from=2013-09-13'
+        )
+        self.assertListEqual(
+            json.loads(resp.data)[4],
+            ['Fri', {'start': 47816.0, 'end': 54242.0}]
+        )
+
+        resp = self.client.get('/api/v1/aggregate/users')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_metrics_view(self):
+        """
+        Test timings and cache counters in Prometheus text format.
+        """
+        resp = self.client.get('/api/v1/_metrics')
+        self.assertEqual(resp.status_code, 404)
+
+        main.app.config['METRICS'] = True
+        self.addCleanup(main.app.config.pop, 'METRICS')
+        self.addCleanup(metrics.clear)
+        metrics.clear()
+        self.client.get('/api/v1/presence_weekday/10')
+        self.client.get('/api/v1/presence_weekday/10')
+        self.client.get('/api/v1/presence_weekday/1')
+
+        resp = self.client.get('/api/v1/_metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, metrics.CONTENT_TYPE)
+        lines = resp.data.splitlines()
+        self.assertIn(
+            'presence_request_seconds_count{endpoint="presence_weekday_view",'
+            'method="GET",status="200"} 2',
+            lines
+        )
+        self.assertIn(
+            'presence_request_seconds_count{endpoint="presence_weekday_view",'
+            'method="GET",status="404"} 1',
+            lines
+        )
+        self.assertIn(
+            'presence_stage_seconds_count{stage="get_data"} 1', lines
+        )
+        self.assertIn(
+            'presence_stage_seconds_count{stage="load_presence_csv"} 1', lines
+        )
+        self.assertIn(
+            'presence_stage_seconds_count{stage="json_encode"} 1', lines
+        )
+        self.assertIn('# TYPE presence_cache_hits_total counter', lines)
+        self.assertTrue(any(
+            line.startswith('presence_cache_misses_total{cache="get_data"} ')
+            for line in lines
+        ))
+
+    def test_ready_view(self):
+        """
+        Test readiness reported after warm-up with pre-rendered responses.
+        """
+        resp = self.client.get('/api/v1/_ready')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data), {'ready': True})
+
+        warmup.READY.clear()
+        warmup.DONE.clear()
+        self.addCleanup(warmup.READY.set)
+        self.addCleanup(warmup.DONE.set)
+        resp = self.client.get('/api/v1/_ready')
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(
+            json.loads(resp.data), {'ready': False, 'failed': False}
+        )
+
+        main.app.config['DATA_CSV'] = os.path.join(self.id(), 'missing.csv')
+        self.assertIsNone(warmup.start())
+        self.assertTrue(warmup.failed())
+        resp = self.client.get('/api/v1/_ready')
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(
+            json.loads(resp.data), {'ready': False, 'failed': True}
+        )
+        main.app.config['DATA_CSV'] = TEST_DATA_CSV
+        utils.clear_cache()
+
+        self.assertEqual(warmup.start(), 24)
+        self.assertTrue(warmup.ready())
+        self.assertItemsEqual(utils.get_data().running.keys(), [10, 11])
+        version = utils.snapshot_version()[0]
+        responses = utils.CACHE['jsonify']
+        self.assertIsNotNone(responses.lookup(version, '/api/v1/users?'))
+        self.assertIsNotNone(
+            responses.lookup(version, '/api/v1/presence_weekday/10?')
+        )
+        resp = self.client.get('/api/v1/_ready')
+        self.assertEqual(resp.status_code, 200)
+
+        thread = warmup.start(background=True)
+        thread.join()
+        self.assertTrue(warmup.ready())
+        self.assertFalse(warmup.failed())
+
+    def test_profile_view(self):
+        """
+        Test profiling views and reading aggregated stats.
+        """
+        resp = self.client.get('/api/v1/_profile')
+        self.assertEqual(resp.status_code, 404)
+
+        self.addCleanup(
+            main.app.view_functions.update, dict(main.app.view_functions)
+        )
+        self.addCleanup(profiling.clear)
+        self.addCleanup(setattr, main.app, 'debug', main.app.debug)
+        profiling.clear()
+        profiling.install(main.app)
+        profiling.install(main.app)
+        view = main.app.view_functions['presence_weekday_view']
+        self.assertEqual(view.endpoint, 'presence_weekday_view')
+        self.assertFalse(hasattr(main.app.view_functions['profile_view'],
+                                 'endpoint'))
+
+        main.app.debug = True
+        self.client.get('/api/v1/presence_weekday/10')
+        self.client.get('/api/v1/presence_weekday/10?_profile=1')
+        self.client.get('/api/v1/presence_weekday/11?_profile=1')
+        resp = self.client.get('/api/v1/_profile')
+        self.assertEqual(resp.status_code, 200)
+        self.assertDictEqual(
+            json.loads(resp.data), {'presence_weekday_view': 2}
+        )
+
+        resp = self.client.get('/api/v1/_profile/presence_weekday_view')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'text/plain')
+        self.assertIn('2 profiled requests', resp.data)
+        self.assertIn('presence_weekday_view', resp.data)
+
+        # cached and not modified responses still run the view
+        etag = self.client.get(
+            '/api/v1/presence_weekday/10?_profile=1'
+        ).headers['ETag']
+        resp = self.client.get(
+            '/api/v1/presence_weekday/10?_profile=1',
+            headers={'If-None-Match': etag}
+        )
+        self.assertEqual(resp.status_code, 200)
+        stats = profiling.PROFILES['presence_weekday_view'][0].stats
+        calls = dict(
+            (name, stat[1]) for (_, _, name), stat in stats.iteritems()
+        )
+        self.assertEqual(calls['presence_weekday_view'], 4)
+        self.assertEqual(calls['total_by_weekday'], 4)
+        resp = self.client.get(
+            '/api/v1/_profile/presence_weekday_view?limit=5&sort=calls'
+        )
+        self.assertIn('List reduced from', resp.data)
+
+        resp = self.client.get(
+            '/api/v1/_profile/presence_weekday_view?format=pstats'
+        )
+        self.assertEqual(resp.content_type, 'application/octet-stream')
+        handle, path = tempfile.mkstemp(suffix='.pstats')
+        os.write(handle, resp.data)
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        self.assertGreater(pstats.Stats(path).total_calls, 0)
+
+        resp = self.client.get('/api/v1/_profile/presence_weekday_view?sort=x')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get('/api/v1/_profile/users_view')
+        self.assertEqual(resp.status_code, 404)
+
+        main.app.debug = False
+        main.app.config['PROFILE_SAMPLE_RATE'] = 1
+        self.addCleanup(main.app.config.pop, 'PROFILE_SAMPLE_RATE')
+        self.client.get('/api/v1/users')
+        self.assertEqual(profiling.counts()['users_view'], 1)
+
     def test_presence_startend_view_404(self):
         """
         Test api presence start end view for unexisting user.
@@ -234,6 +671,29 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         self.assertGreaterEqual(data[2]['mean'], data[3]['mean'])
         self.assertGreaterEqual(data[3]['mean'], data[4]['mean'])
 
+    def test_presence_top_users_monthly_view_limit(self):
+        # pylint: disable=invalid-name
+        """
+        Test api returning top users for month with custom limit.
+        """
+        resp = self.client.get('/api/v1/top5monthly/September?limit=1')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['user_id'], 10)
+        self.assertEqual(data[0]['name'], 'Maciej Z.')
+
+        resp = self.client.get('/api/v1/top5monthly/September?limit=20')
+        data = json.loads(resp.data)
+        self.assertItemsEqual(
+            [user['user_id'] for user in data],
+            [10, 11, 26, 141, 170, 176]
+        )
+        self.assertEqual(data[1]['user_id'], 11)
+
+        resp = self.client.get('/api/v1/top5monthly/September?limit=0')
+        self.assertEqual(resp.status_code, 400)
+
     def test_presence_top_5_users_monthly_view_404(self):
         # pylint: disable=invalid-name
         """
@@ -242,6 +702,14 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         resp = self.client.get('/api/v1/month/14')
         self.assertEqual(resp.status_code, 404)
 
+    def test_api_non_ascii_path_404(self):
+        """
+        Test non-ASCII path segments aren't found instead of failing.
+        """
+        for path in ('top5monthly', 'aggregate', 'bulk'):
+            resp = self.client.get('/api/v1/{}/%C5%BB'.format(path))
+            self.assertEqual(resp.status_code, 404)
+
 
 class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
     """
@@ -270,8 +738,10 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         Test parsing of CSV file.
         """
         data = utils.get_data()
-        self.assertIsInstance(data, dict)
+        self.assertIsInstance(data, PresenceStore)
         self.assertItemsEqual(data.keys(), [10, 11])
+        self.assertItemsEqual(data.running.keys(), [10, 11])
+        self.assertIsNotNone(data.company)
         sample_date = datetime.date(2013, 9, 10)
         self.assertIn(sample_date, data[10])
         self.assertItemsEqual(data[10][sample_date].keys(), ['start', 'end'])
@@ -280,35 +750,394 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
             datetime.time(9, 39, 5)
         )
 
+    def test_read_presence_csv(self):
+        """
+        Test fast path gives the same rows as strict parsing.
+        """
+        lines = [
+            'user_id,date,start,end\n',
+            '10,2013-09-10,09:39:05,17:59:52\r\n',
+            '10,2013-09-11,9:19:52,16:07:37\n',
+            '"11",2013-09-05,09:28:08,15:51:27\n',
+            '11,2013-09-31,09:28:08,15:51:27\n',
+            '11,09:28:08,2013-09-05,15:51:27\n',
+            '11,2013-09-06,24:00:00,15:51:27\n',
+            '11,2013-09-09,09:12:14\n',
+        ]
+        day = datetime.date(2013, 9, 10).toordinal()
+        self.assertListEqual(
+            list(utils.read_presence_csv(lines)),
+            [
+                (10, day, 34745, 64792),
+                (10, day + 1, 33592, 58057),
+                (11, day - 5, 34088, 57087),
+            ]
+        )
+
+    def test_parse_fixed_width_line(self):
+        """
+        Test parsing presence line in fixed layout.
+        """
+        ordinals, seconds = {}, {}
+        self.assertEqual(
+            utils.parse_fixed_width_line(
+                '10,2013-09-10,09:39:05,17:59:52\n', ordinals, seconds
+            ),
+            (10, datetime.date(2013, 9, 10).toordinal(), 34745, 64792)
+        )
+        self.assertIn('2013-09-10', ordinals)
+        self.assertItemsEqual(seconds.keys(), ['09:39:05', '17:59:52'])
+        for line in ('10,2013-9-10,09:39:05,17:59:52',
+                     '10,2013-09-10,9:39:05,17:59:52',
+                     '10,2013-09-10,09:39:05,17:60:52',
+                     '10,2013-09-10,09:39:05',
+                     'x,2013-09-10,09:39:05,17:59:52'):
+            self.assertRaises(
+                ValueError,
+                utils.parse_fixed_width_line, line, ordinals, seconds
+            )
+
+    def test_iter_json(self):
+        """
+        Test encoding JSON in chunks.
+        """
+        value = {
+            'users': [{'user_id': i, 'name': 'x' * 10} for i in range(50)]
+        }
+        chunks = list(utils.iter_json(value, chunk_size=100))
+        self.assertGreater(len(chunks), 5)
+        self.assertTrue(all(len(chunk) >= 100 for chunk in chunks[:-1]))
+        self.assertEqual(json.loads(''.join(chunks)), value)
+        self.assertListEqual(list(utils.iter_json([])), ['[]'])
+
     def test_get_data_xml(self):
         """
         Test parsing of XML file.
         """
         data = utils.get_data_xml()
-        self.assertIsInstance(data, dict)
+        self.assertIsInstance(data, UserTable)
         self.assertItemsEqual(data.keys(), [10, 11, 176, 170, 26, 141])
         self.assertItemsEqual(data[26].keys(), ['avatar', 'name'])
         self.assertTrue(data[26]['avatar'].startswith('https://host:443/'))
         self.assertEqual(data[176]['name'], 'Adrian K.')
 
+    def test_polish_sort_key(self):
+        """
+        Test sorting names in Polish alphabetical order.
+        """
+        names = [
+            'Łukasz', 'lech', 'Żaneta', 'Źdźbło', 'Zenon', 'Ćma', 'Cezary',
+            'Élise', 'Adam P.', 'Adam', 'Ania', 'Øyvind', 'Ðorđe', 'Борис',
+        ]
+        self.assertListEqual(
+            sorted(names, key=utils.polish_sort_key),
+            [
+                'Adam', 'Adam P.', 'Ania', 'Cezary', 'Ćma', 'Élise', 'lech',
+                'Łukasz', 'Zenon', 'Źdźbło', 'Żaneta', 'Ðorđe', 'Øyvind',
+                'Борис',
+            ]
+        )
+
+    def test_read_users_xml(self):
+        """
+        Test reading users table with server defined after users.
+        """
+        xmlfile = io.BytesIO(
+            b'<intranet><users>'
+            b'<user id="1"><avatar>/a/1</avatar><name>A</name></user>'
+            b'<user id="2"><avatar>/a/2</avatar><name>B</name></user>'
+            b'<user id="1"><avatar>/a/3</avatar><name>C</name></user>'
+            b'</users><server><host>h</host><port>80</port>'
+            b'<protocol>http</protocol></server></intranet>'
+        )
+        table = utils.read_users_xml(xmlfile)
+        self.assertEqual(table.server, 'http://h:80')
+        self.assertListEqual(list(table.ids), [1, 2])
+        self.assertListEqual(table.names, ['C', 'B'])
+        self.assertListEqual(table.avatars, ['/a/3', '/a/2'])
+        self.assertDictEqual(
+            table[2], {'avatar': 'http://h:80/a/2', 'name': 'B'}
+        )
+
+    def test_sorted_ids(self):
+        """
+        Test users are sorted by name when XML is loaded.
+        """
+        data = utils.get_data_xml()
+        self.assertListEqual(
+            data.sorted_ids, [141, 176, 170, 26, 11, 10]
+        )
+
     def test_memoize(self):
         """
         Test memorize data and updating if expired.
         """
+        utils.clear_cache()
+        self.addCleanup(utils.clear_cache)
+        cache = utils.CACHE['get_data']
+        before = cache.stats()
         utils.get_data()
         self.assertIn('get_data', utils.CACHE)
-        self.assertIn('value', utils.CACHE['get_data'])
-        self.assertIn('time', utils.CACHE['get_data'])
-        utils.CACHE['get_data']['time'] = 0
+        self.assertIn((), cache.entries)
+        self.assertIn('value', cache.entries[()])
+        self.assertIn('time', cache.entries[()])
+        cache.entries[()]['time'] = 0
         utils.get_data()
-        self.assertNotEqual(utils.CACHE['get_data']['time'], 0)
+        self.assertNotEqual(cache.entries[()]['time'], 0)
         utils.get_data_xml()
-        self.assertEqual(len(utils.CACHE), 2)
         self.assertIn('get_data_xml', utils.CACHE)
+        self.assertEqual(len(utils.CACHE['get_data_xml'].entries), 1)
         future_time = tm() + 100
-        utils.CACHE['get_data'] = {'time': future_time, 'value': 'test'}
-        utils.get_data()
-        self.assertEqual(utils.CACHE['get_data']['value'], 'test')
+        cache.entries[()] = {'time': future_time, 'value': 'test'}
+        self.assertEqual(utils.get_data(), 'test')
+        stats = cache.stats()
+        self.assertEqual(stats['hits'] - before['hits'], 1)
+        self.assertEqual(stats['misses'] - before['misses'], 2)
+        self.assertEqual(stats['loads'] - before['loads'], 2)
+
+    def test_memoize_arguments(self):
+        """
+        Test memoized values are kept per arguments with LRU eviction.
+        """
+        calls = []
+
+        @utils.memoize(100, maxsize=2)
+        def square(number):  # pylint: disable=missing-docstring
+            calls.append(number)
+            return number * number
+
+        self.assertEqual(square(2), 4)
+        self.assertEqual(square(3), 9)
+        self.assertEqual(square(3), 9)
+        self.assertListEqual(calls, [2, 3])
+        self.assertEqual(square(number=2), 4)
+        self.assertListEqual(calls, [2, 3, 2])
+        self.assertListEqual(
+            square.cache.entries.keys(), [(3,), (('number', 2),)]
+        )
+        self.assertEqual(square(2), 4)
+        self.assertListEqual(calls, [2, 3, 2, 2])
+        del utils.CACHE['square']
+
+    def test_memoize_single_flight(self):
+        """
+        Test concurrent misses of the same key call function once.
+        """
+        calls = []
+        started = threading.Event()
+        release = threading.Event()
+
+        @utils.memoize(100)
+        def slow(number):  # pylint: disable=missing-docstring
+            calls.append(number)
+            started.set()
+            release.wait()
+            return number
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(slow(1)))
+            for _ in range(3)
+        ]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        self.assertEqual(slow.cache.get((2,), lambda: 2, 100), 2)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertListEqual(calls, [1])
+        self.assertListEqual(results, [1, 1, 1])
+        del utils.CACHE['slow']
+
+    def test_reload_on_change(self):
+        """
+        Test data is reloaded in background when the file changes.
+        """
+        handle, path = tempfile.mkstemp(suffix='.csv')
+        os.write(handle, b'10,2013-09-10,09:39:05,17:59:52\n')
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        self.addCleanup(utils.clear_cache)
+        self.addCleanup(main.app.config.update, {
+            'DATA_CSV': TEST_DATA_CSV,
+            'RELOAD_ON_CHANGE': False,
+        })
+        main.app.config.update({
+            'DATA_CSV': path,
+            'RELOAD_ON_CHANGE': True,
+            'RELOAD_CHECK_INTERVAL': 0,
+        })
+        utils.clear_cache()
+        cache = utils.CACHE['get_data']
+
+        data = utils.get_data()
+        self.assertItemsEqual(data.keys(), [10])
+        self.assertIs(utils.get_data(), data)
+        self.assertDictEqual(cache.loading, {})
+
+        with open(path, 'a') as csvfile:
+            csvfile.write(b'11,2013-09-05,09:28:08,15:51:27\n')
+        main.app.config['RELOAD_CHECK_INTERVAL'] = 100
+        self.assertIs(utils.get_data(), data)
+        self.assertDictEqual(cache.loading, {})
+
+        main.app.config['RELOAD_CHECK_INTERVAL'] = 0
+        self.assertIs(utils.get_data(), data)
+        event = cache.loading.get(())
+        if event is not None:
+            event.wait()
+        self.assertItemsEqual(utils.get_data().keys(), [10, 11])
+
+    def test_refresher(self):
+        """
+        Test refresher reloads changed data off the request path.
+        """
+        handle, path = tempfile.mkstemp(suffix='.csv')
+        os.write(handle, b'10,2013-09-10,09:39:05,17:59:52\n')
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        self.addCleanup(utils.clear_cache)
+        self.addCleanup(main.app.config.update, {'DATA_CSV': TEST_DATA_CSV})
+        main.app.config['DATA_CSV'] = path
+        utils.clear_cache()
+        cache = utils.CACHE['get_data']
+
+        refresher = utils.start_refresher(100)
+        self.addCleanup(utils.stop_refresher)
+        self.assertIs(utils.REFRESHER, refresher)
+        self.assertIn(utils.get_data, utils.WATCHED)
+        data = cache.peek(())
+        self.assertItemsEqual(data.keys(), [10])
+
+        loads = cache.stats()['loads']
+        self.assertIs(utils.get_data(), data)
+        refresher.refresh()
+        self.assertEqual(cache.stats()['loads'], loads)
+
+        with open(path, 'a') as csvfile:
+            csvfile.write(b'11,2013-09-05,09:28:08,15:51:27\n')
+        self.assertIs(utils.get_data(), data)
+        refresher.refresh()
+        self.assertEqual(cache.stats()['loads'], loads + 1)
+        self.assertItemsEqual(utils.get_data().keys(), [10, 11])
+
+        utils.stop_refresher()
+        self.assertIsNone(utils.REFRESHER)
+        self.assertFalse(refresher.thread.is_alive())
+
+    def test_load_presence_csv_parallel(self):
+        """
+        Test parallel parsing gives the same store as the serial one.
+        """
+        handle, path = tempfile.mkstemp(suffix='.csv')
+        os.write(handle, b'11,2013-09-05,09:28:08,15:51:27\nbroken\n')
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        self.addCleanup(setattr, utils, 'PARALLEL_MIN_SIZE',
+                        utils.PARALLEL_MIN_SIZE)
+        utils.PARALLEL_MIN_SIZE = 0
+
+        with open(path, 'a') as csvfile, open(TEST_DATA_CSV) as data:
+            csvfile.write(data.read())
+            csvfile.write(b'\n10,2013-09-10,09:00:00,17:00:00\n12,2013')
+        self.addCleanup(utils.stop_pool)
+        pool = utils.start_pool(3)
+        for csv_path in (TEST_DATA_CSV, path):
+            serial = utils.load_presence_csv(csv_path)
+            parallel = utils.load_presence_csv(csv_path, workers=3)
+            self.assertIs(utils.POOL, pool)
+            for column in ('users', 'dates', 'starts', 'ends'):
+                self.assertEqual(
+                    getattr(parallel, column), getattr(serial, column)
+                )
+            self.assertDictEqual(parallel.source, serial.source)
+        self.assertEqual(
+            serial[10][datetime.date(2013, 9, 10)]['start'],
+            datetime.time(9, 0, 0)
+        )
+
+        utils.stop_pool()
+        self.assertIsNone(utils.POOL)
+        self.assertEqual(
+            utils.load_presence_csv(path, workers=3).users, serial.users
+        )
+
+    def test_split_lines(self):
+        """
+        Test file is split into ranges on line boundaries.
+        """
+        lines = io.BytesIO(b'1\n22\n333\n4444')
+        self.assertListEqual(
+            utils.split_lines(lines, 13, 3), [(0, 5), (5, 9), (9, 13)]
+        )
+        self.assertListEqual(
+            utils.split_lines(lines, 13, 20),
+            [(0, 2), (2, 5), (5, 9), (9, 13)]
+        )
+        self.assertListEqual(utils.split_lines(lines, 0, 3), [(0, 0)])
+
+    def test_append_presence_csv(self):
+        """
+        Test only lines appended to the file are parsed on reload.
+        """
+        handle, path = tempfile.mkstemp(suffix='.csv')
+        os.write(handle, b'10,2013-09-10,09:39:05,17:59:52\n11,2013-09-05')
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+
+        store = utils.load_presence_csv(path)
+        self.assertItemsEqual(store.keys(), [10])
+        self.assertEqual(store.source['offset'], 32)
+        self.assertIs(utils.append_presence_csv(store), store)
+
+        with open(path, 'a') as csvfile:
+            csvfile.write(
+                b',09:28:08,15:51:27\n10,2013-09-11,09:19:52,16:07:37'
+            )
+        appended = utils.append_presence_csv(store)
+        self.assertItemsEqual(appended.keys(), [10, 11])
+        self.assertEqual(len(appended[10]), 2)
+        self.assertEqual(appended.source['offset'], 64)
+        self.assertEqual(store.source['offset'], 32)
+
+        with open(path, 'w') as csvfile:
+            csvfile.write(b'12,2013-09-10,09:39:05,17:59:52\n')
+        self.assertIsNone(utils.append_presence_csv(appended))
+
+    def test_get_data_appended(self):
+        """
+        Test get_data merges appended lines into cached store.
+        """
+        handle, path = tempfile.mkstemp(suffix='.csv')
+        os.write(handle, b'10,2013-09-10,09:39:05,17:59:52\n')
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        self.addCleanup(utils.clear_cache)
+        self.addCleanup(main.app.config.update, {'DATA_CSV': TEST_DATA_CSV})
+        main.app.config['DATA_CSV'] = path
+        utils.clear_cache()
+        cache = utils.CACHE['get_data']
+
+        self.assertItemsEqual(utils.get_data().keys(), [10])
+        with open(path, 'a') as csvfile:
+            csvfile.write(b'11,2013-09-05,09:28:08,15:51:27\n')
+        cache.entries[()]['time'] = 0
+        data = utils.get_data()
+        self.assertItemsEqual(data.keys(), [10, 11])
+        self.assertEqual(
+            data.source['tail'], '11,2013-09-05,09:28:08,15:51:27\n'
+        )
+
+    def test_file_signature(self):
+        """
+        Test file signature changes with file content.
+        """
+        signature = utils.file_signature(TEST_DATA_CSV)
+        self.assertEqual(signature, utils.file_signature(TEST_DATA_CSV))
+        self.assertNotEqual(signature, utils.file_signature(TEST_DATA_XML))
+        self.assertIsNone(utils.file_signature(TEST_DATA_CSV + '.missing'))
 
     def test_group_by_weekday(self):
         """
@@ -321,6 +1150,115 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
             [[], [30047], [24465], [23705], [], [], []]
         )
 
+    def test_total_by_weekday(self):
+        """
+        Test total presence time by weekday.
+        """
+        sample_data = utils.get_data()
+        self.assertListEqual(
+            utils.total_by_weekday(utils.range_stats(sample_data[10])),
+            [0, 30047, 24465, 23705, 0, 0, 0]
+        )
+
+    def test_mean_by_weekday(self):
+        """
+        Test mean presence time by weekday.
+        """
+        sample_data = utils.get_data()
+        self.assertListEqual(
+            utils.mean_by_weekday(utils.range_stats(sample_data[11])),
+            [24123.0, 16564.0, 25321.0, 22984.0, 6426.0, 0, 0]
+        )
+
+    def test_range_stats(self):
+        """
+        Test aggregates of user entries in date range.
+        """
+        sample_data = utils.get_data()
+        stats = utils.range_stats(sample_data[11])
+        self.assertIs(stats, sample_data[11].aggregates)
+        for first, last in ((None, datetime.date(2013, 9, 10)),
+                            (datetime.date(2013, 9, 6), None),
+                            (datetime.date(2013, 9, 9),
+                             datetime.date(2013, 9, 12)),
+                            (datetime.date(2013, 9, 12),
+                             datetime.date(2013, 9, 11))):
+            first_day = first.toordinal() if first else 0
+            last_day = last.toordinal() if last else float('inf')
+            scanned = PresenceStore.from_rows(
+                (11, ordinal, start, end)
+                for ordinal, start, end in sample_data[11].rows()
+                if first_day <= ordinal <= last_day
+            )
+            self.assertDictEqual(
+                utils.range_stats(sample_data[11], first, last),
+                scanned.aggregates.get(11, scanned.aggregate(0, 0, {}))
+            )
+        stats = utils.range_stats(
+            sample_data[11], datetime.date(2013, 9, 10)
+        )
+        self.assertListEqual(
+            stats['weekday_count'], [0, 1, 1, 1, 1, 0, 0]
+        )
+
+    def test_company_stats(self):
+        """
+        Test summing aggregates of all users.
+        """
+        sample_data = utils.get_data()
+        stats = utils.company_stats(sample_data)
+        self.assertListEqual(
+            stats['weekday_count'], [1, 2, 2, 3, 1, 0, 0]
+        )
+        self.assertListEqual(
+            stats['weekday_total'],
+            [
+                sum(sample_data[user_id].aggregates['weekday_total'][day]
+                    for user_id in sample_data)
+                for day in range(7)
+            ]
+        )
+        stats = utils.company_stats(
+            sample_data, last=datetime.date(2013, 1, 1)
+        )
+        self.assertListEqual(stats['month_count'], [0] * 12)
+
+        first, last = datetime.date(2013, 9, 10), datetime.date(2013, 9, 12)
+        stats = utils.company_stats(sample_data, first, last)
+        for name, values in stats.iteritems():
+            self.assertListEqual(values, [
+                sum(column) for column in zip(*(
+                    utils.range_stats(sample_data[user_id], first, last)[name]
+                    for user_id in sample_data
+                ))
+            ])
+        self.assertIs(sample_data.company_sums(), sample_data.company_sums())
+        self.assertEqual(sample_data.company_sums()[0].sums[0].typecode, 'l')
+
+    def test_timed(self):
+        """
+        Test stage timing is collected only when enabled.
+        """
+        self.addCleanup(metrics.clear)
+        metrics.clear()
+        utils.company_stats(utils.get_data())
+        self.assertDictEqual(metrics.STAGES.values, {})
+
+        main.app.config['METRICS'] = True
+        self.addCleanup(main.app.config.pop, 'METRICS')
+        utils.company_stats(utils.get_data())
+        self.assertEqual(metrics.STAGES.values[('company_stats',)][0], 1)
+        self.assertNotIn(('range_stats',), metrics.STAGES.values)
+        main.app.config['METRICS'] = False
+        self.assertIs(metrics.stage('test'), metrics.NULL_TIMER)
+
+    def test_average(self):
+        """
+        Test calculating arithmetic mean from sum and count.
+        """
+        self.assertEqual(utils.average(6, 3), 2.0)
+        self.assertEqual(utils.average(0, 0), 0)
+
     def test_seconds_since_midnight(self):
         """
         Test calculating amount of seconds since midnight.
@@ -363,7 +1301,9 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         Test calculating mean entries for every weekday.
         """
         sample_data = utils.get_data()
-        result = utils.mean_time_of_presence(sample_data[10])
+        result = utils.mean_time_of_presence(
+            utils.range_stats(sample_data[10])
+        )
         self.assertDictEqual(
             result,
             {
@@ -383,7 +1323,7 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         """
         data = utils.get_data()
         sample_data_user = data[10]
-        result = utils.mean_by_month(sample_data_user)
+        result = utils.mean_by_month(utils.range_stats(sample_data_user))
         self.assertListEqual(
             result,
             [
@@ -394,6 +1334,517 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         )
 
 
+class PresenceStoreTestCase(unittest.TestCase):
+    """
+    Presence store tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.day = datetime.date(2013, 9, 10).toordinal()
+        self.store = PresenceStore.from_rows([
+            (11, self.day + 1, 100, 200),
+            (10, self.day + 2, 300, 400),
+            (10, self.day, 500, 600),
+            (11, self.day + 1, 700, 800),
+        ])
+
+    def test_columns(self):
+        """
+        Test entries are sorted by user and date with duplicates merged.
+        """
+        self.assertListEqual(list(self.store.users), [10, 10, 11])
+        self.assertListEqual(
+            list(self.store.dates),
+            [self.day, self.day + 2, self.day + 1]
+        )
+        self.assertListEqual(list(self.store.starts), [500, 300, 700])
+        self.assertListEqual(list(self.store.ends), [600, 400, 800])
+        self.assertDictEqual(self.store.offsets, {10: (0, 2), 11: (2, 3)})
+
+    def test_user_presence(self):
+        """
+        Test user view behaves like the old nested dict.
+        """
+        self.assertItemsEqual(self.store.keys(), [10, 11])
+        self.assertNotIn(12, self.store)
+        self.assertRaises(KeyError, lambda: self.store[12])
+        user = self.store[10]
+        self.assertEqual(len(user), 2)
+        self.assertListEqual(
+            list(user),
+            [datetime.date(2013, 9, 10), datetime.date(2013, 9, 12)]
+        )
+        self.assertDictEqual(
+            user[datetime.date(2013, 9, 12)],
+            {'start': datetime.time(0, 5), 'end': datetime.time(0, 6, 40)}
+        )
+        self.assertNotIn(datetime.date(2013, 9, 11), user)
+        self.assertListEqual(
+            list(user.rows()),
+            [(self.day, 500, 600), (self.day + 2, 300, 400)]
+        )
+
+    def test_aggregates(self):
+        """
+        Test aggregates are computed for every user.
+        """
+        self.assertDictEqual(
+            self.store[10].aggregates,
+            {
+                'weekday_total': [0, 100, 0, 100, 0, 0, 0],
+                'weekday_count': [0, 1, 0, 1, 0, 0, 0],
+                'weekday_start': [0, 500, 0, 300, 0, 0, 0],
+                'weekday_end': [0, 600, 0, 400, 0, 0, 0],
+                'month_total': [0] * 8 + [200, 0, 0, 0],
+                'month_count': [0] * 8 + [2, 0, 0, 0],
+            }
+        )
+        self.store.build_running_sums()
+        merged = self.store.merge([(11, self.day, 0, 50)])
+        self.assertIs(merged.aggregates[10], self.store.aggregates[10])
+        self.assertEqual(merged.aggregates[11]['month_total'][8], 150)
+        self.assertDictEqual(merged.running, {10: self.store.running[10]})
+        self.assertEqual(
+            merged.range_aggregates(11, self.day)['month_total'][8], 150
+        )
+
+    def test_running_sums(self):
+        """
+        Test running sums of user entries by weekday and month.
+        """
+        weekdays, months = self.store.running_sums(10)
+        self.assertIs(self.store.running_sums(10)[0], weekdays)
+        self.assertListEqual(weekdays.bounds, [0, 0, 1, 1, 2, 2, 2, 2])
+        self.assertListEqual(list(weekdays.sums[0]), [0, 100, 200])
+        self.assertEqual(weekdays.sums[0].typecode, 'i')
+        self.assertListEqual(
+            list(weekdays.between()),
+            [
+                [0, 1, 0, 1, 0, 0, 0],
+                [0, 100, 0, 100, 0, 0, 0],
+                [0, 500, 0, 300, 0, 0, 0],
+                [0, 600, 0, 400, 0, 0, 0],
+            ]
+        )
+        self.assertListEqual(
+            months.between(self.day + 1),
+            [[0] * 8 + [1, 0, 0, 0], [0] * 8 + [100, 0, 0, 0]]
+        )
+        self.assertDictEqual(
+            self.store.range_aggregates(10, self.day, self.day + 2),
+            self.store.aggregates[10]
+        )
+        self.assertDictEqual(
+            self.store.range_aggregates(10, last=self.day + 1),
+            {
+                'weekday_total': [0, 100, 0, 0, 0, 0, 0],
+                'weekday_count': [0, 1, 0, 0, 0, 0, 0],
+                'weekday_start': [0, 500, 0, 0, 0, 0, 0],
+                'weekday_end': [0, 600, 0, 0, 0, 0, 0],
+                'month_total': [0] * 8 + [100, 0, 0, 0],
+                'month_count': [0] * 8 + [1, 0, 0, 0],
+            }
+        )
+        self.assertEqual(
+            self.store.range_aggregates(10, self.day + 3)['weekday_count'],
+            [0] * 7
+        )
+
+    def test_month_rankings(self):
+        """
+        Test users are ranked by mean presence in every month.
+        """
+        self.assertEqual(len(self.store.month_rankings), 12)
+        self.assertListEqual(
+            self.store.month_rankings[8], [(10, 100.0), (11, 100.0)]
+        )
+        merged = self.store.merge([(10, self.day + 7, 0, 400)])
+        self.assertListEqual(
+            merged.month_rankings[8], [(10, 200.0), (11, 100.0)]
+        )
+        self.assertListEqual(merged.month_rankings[0], [(10, 0), (11, 0)])
+
+    def test_merge(self):
+        """
+        Test merging rows creates new store with entries sorted by date.
+        """
+        merged = self.store.merge([
+            (10, self.day + 3, 1, 2),
+            (11, self.day, 3, 4),
+            (12, self.day, 5, 6),
+            (10, self.day + 2, 7, 8),
+        ])
+        self.assertListEqual(list(merged.users), [10, 10, 10, 11, 11, 12])
+        self.assertListEqual(
+            list(merged[10].rows()),
+            [
+                (self.day, 500, 600),
+                (self.day + 2, 7, 8),
+                (self.day + 3, 1, 2),
+            ]
+        )
+        self.assertListEqual(
+            list(merged[11].rows()),
+            [(self.day, 3, 4), (self.day + 1, 700, 800)]
+        )
+        self.assertListEqual(list(merged[12].rows()), [(self.day, 5, 6)])
+        self.assertEqual(len(self.store.users), 3)
+
+
+class SnapshotTestCase(unittest.TestCase):
+    """
+    Binary snapshot tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        handle, self.path = tempfile.mkstemp(suffix='.bin')
+        os.close(handle)
+        main.app.config.update(
+            {
+                'DATA_CSV': TEST_DATA_CSV,
+                'DATA_XML': TEST_DATA_XML,
+                'DATA_SNAPSHOT': self.path,
+            }
+        )
+        utils.clear_cache()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.app.config.pop('DATA_SNAPSHOT')
+        utils.clear_cache()
+        os.remove(self.path)
+
+    def test_read_write(self):
+        """
+        Test data read from snapshot equals written data.
+        """
+        store, table = utils.get_data(), utils.get_data_xml()
+        snapshot.write_snapshot(self.path, store, table)
+
+        loaded = snapshot.read_presence(self.path)
+        for column in snapshot.COLUMNS:
+            self.assertEqual(getattr(loaded, column), getattr(store, column))
+        self.assertDictEqual(loaded.offsets, store.offsets)
+        self.assertDictEqual(loaded.aggregates, store.aggregates)
+        self.assertListEqual(loaded.month_rankings, store.month_rankings)
+        self.assertDictEqual(loaded.source, store.source)
+
+        loaded = snapshot.read_users(self.path)
+        self.assertDictEqual(dict(loaded), dict(table))
+        self.assertEqual(loaded.server, table.server)
+        self.assertDictEqual(loaded.source, table.source)
+
+    def test_write_mode(self):
+        """
+        Test snapshot is readable by other users, respecting umask.
+        """
+        umask = os.umask(0o027)
+        self.addCleanup(os.umask, umask)
+        snapshot.write_snapshot(
+            self.path, utils.get_data(), utils.get_data_xml()
+        )
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o640)
+        os.umask(0o022)
+        snapshot.write_snapshot(
+            self.path, utils.get_data(), utils.get_data_xml()
+        )
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o644)
+
+    def test_read_invalid(self):
+        """
+        Test reading file which isn't a snapshot.
+        """
+        self.assertRaises(ValueError, snapshot.read_presence, self.path)
+        self.assertRaises(ValueError, snapshot.read_users, TEST_DATA_XML)
+        self.assertIsInstance(utils.get_data(), PresenceStore)
+
+    def test_get_data_from_snapshot(self):
+        """
+        Test loaders use snapshot compiled from current files.
+        """
+        store = utils.load_presence_csv(TEST_DATA_CSV)
+        changed = store.merge([(99, 735000, 0, 100)])
+        changed.source = store.source
+        table = utils.get_data_xml()
+        table.add(99, 'Snapshot U.', '/api/images/users/99')
+        snapshot.write_snapshot(self.path, changed, table)
+        utils.clear_cache()
+
+        self.assertIn(99, utils.get_data())
+        self.assertIn(99, utils.get_data_xml())
+
+        table.source = dict(table.source, size=0)
+        snapshot.write_snapshot(self.path, changed, table)
+        utils.clear_cache()
+        self.assertNotIn(99, utils.get_data_xml())
+
+    def test_read_shared(self):
+        """
+        Test store reading memory-mapped snapshot columns.
+        """
+        store = utils.get_data()
+        snapshot.write_snapshot(self.path, store, utils.get_data_xml())
+
+        shared = snapshot.read_presence(self.path, shared=True)
+        self.assertIsInstance(shared.dates, snapshot.MappedColumn)
+        for column in snapshot.COLUMNS:
+            self.assertEqual(
+                list(getattr(shared, column)), list(getattr(store, column))
+            )
+        self.assertEqual(shared.dates[-1], store.dates[-1])
+        self.assertEqual(shared.dates[2:5], store.dates[2:5])
+        self.assertRaises(IndexError, lambda: shared.dates[len(store.dates)])
+        self.assertDictEqual(dict(shared[10]), dict(store[10]))
+        self.assertEqual(shared.mapped_source['path'], self.path)
+
+        merged = shared.merge([(10, 735000, 0, 100)])
+        self.assertEqual(len(merged[10]), len(store[10]) + 1)
+
+    def test_get_data_shared(self):
+        """
+        Test shared snapshot is swapped when new one is renamed over it.
+        """
+        store = utils.get_data()
+        table = utils.get_data_xml()
+        snapshot.write_snapshot(self.path, store, table)
+        main.app.config['DATA_SNAPSHOT_SHARED'] = True
+        self.addCleanup(main.app.config.pop, 'DATA_SNAPSHOT_SHARED')
+        utils.clear_cache()
+
+        shared = utils.get_data()
+        self.assertIsNotNone(shared.mapped_source)
+        self.assertEqual(utils.presence_path(), self.path)
+        self.assertIs(utils.read_shared_snapshot(shared), shared)
+
+        changed = store.merge([(99, 735000, 0, 100)])
+        changed.source = store.source
+        snapshot.write_snapshot(self.path, changed, table)
+        swapped = utils.read_shared_snapshot(shared)
+        self.assertIsNot(swapped, shared)
+        self.assertIn(99, swapped)
+        self.assertNotIn(99, shared)
+
+        # mapped file must not be truncated, broken one is renamed over it
+        with open(self.path + '.tmp', 'wb') as snapshot_file:
+            snapshot_file.write('broken')
+        os.rename(self.path + '.tmp', self.path)
+        self.assertIs(utils.read_shared_snapshot(swapped), swapped)
+        self.assertRaises(ValueError, utils.read_shared_snapshot, None)
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    """
+    Benchmark suite tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_generated_data(self):
+        """
+        Test generated files are readable by loaders.
+        """
+        csv_path = os.path.join(self.directory, 'presence.csv')
+        xml_path = os.path.join(self.directory, 'users.xml')
+        self.assertEqual(benchmark.generate_csv(csv_path, 3, 1), 3 * 260)
+        benchmark.generate_xml(xml_path, 3)
+
+        store = utils.load_presence_csv(csv_path)
+        self.assertItemsEqual(store.keys(), [0, 1, 2])
+        self.assertEqual(len(store[0]), 260)
+        table = utils.read_users_xml(xml_path)
+        self.assertItemsEqual(table.keys(), [0, 1, 2])
+
+    def test_run_suite(self):
+        """
+        Test suite times every view and restores app config.
+        """
+        config = dict(main.app.config)
+        results = benchmark.run_suite([2], 1, 0.01, 2, 2, self.directory)
+        self.assertDictEqual(dict(main.app.config), config)
+        self.assertItemsEqual(
+            results['2']['views'].keys(),
+            [name for name, _ in benchmark.VIEWS]
+        )
+        self.assertGreater(results['2']['peak_rss_kb'], 0)
+        self.assertListEqual(benchmark.compare(results, results, 0), [])
+
+    def test_run_suite_ingest(self):
+        """
+        Test ingest sizes run only ingest benchmarks.
+        """
+        results = benchmark.run_suite(
+            [2], 1, 0.01, 2, 1, self.directory, [2, 4]
+        )
+        self.assertIn('views', results['2'])
+        self.assertItemsEqual(
+            results['4'].keys(), ['rows', 'ingest', 'peak_rss_kb']
+        )
+        self.assertEqual(results['4']['rows'], 4 * 260)
+        self.assertItemsEqual(
+            results['4']['ingest'].keys(),
+            ['strict', 'fast', 'serial', 'parallel']
+        )
+
+    def test_compare(self):
+        """
+        Test regressions against baseline.
+        """
+        baseline = {'10': {
+            'rows': 10,
+            'views': {'users': {'p50': 1.0, 'p99': 2.0}},
+            'ingest': {'fast': 100.0},
+        }}
+        results = {'10': {
+            'rows': 20,
+            'views': {'users': {'p50': 1.1, 'p99': 3.0}},
+            'ingest': {'fast': 50.0},
+        }}
+        self.assertListEqual(
+            benchmark.compare(results, baseline, 0.2),
+            [
+                ('10.ingest.fast', 100.0, 50.0),
+                ('10.views.users.p99', 2.0, 3.0),
+            ]
+        )
+
+
+class ScriptTestCase(unittest.TestCase):
+    """
+    Startup utilities tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.marks = os.path.join(self.directory, 'marks')
+        for name in ('RESPAWN_MIN_UPTIME', 'RESPAWN_BACKOFF',
+                     'RESPAWN_MAX_FAILURES'):
+            self.addCleanup(setattr, script, name, getattr(script, name))
+        script.RESPAWN_BACKOFF = 0
+
+    def mark(self):
+        """
+        Marks worker start in file shared by processes.
+        """
+        with open(self.marks, 'a') as marks:
+            marks.write(b'x')
+
+    def count_marks(self):
+        """
+        Returns amount of started workers.
+        """
+        if not os.path.exists(self.marks):
+            return 0
+        return os.path.getsize(self.marks)
+
+    def test_serve_with(self):
+        """
+        Test engine and action validation and dry run output.
+        """
+        self.assertRaises(
+            SystemExit, script._serve_with, 'tornado', 'start', False, 0, True
+        )
+        self.assertRaises(
+            SystemExit, script._serve_with, 'prefork', 'stop', False, 0, True
+        )
+
+        path = os.path.join(self.directory, 'deploy.ini')
+        with open(path, 'w') as ini:
+            ini.write(b'[server:main]\nhost = 127.0.0.1\nport = 2212\n')
+        self.addCleanup(setattr, script, 'DEPLOY_INI', script.DEPLOY_INI)
+        script.DEPLOY_INI = path
+        self.addCleanup(setattr, sys, 'stdout', sys.stdout)
+        sys.stdout = io.BytesIO()
+        script._serve_with('prefork', 'fg', False, 3, True)
+        self.assertEqual(
+            sys.stdout.getvalue(),
+            b'prefork engine, 3 processes on 127.0.0.1:2212\n'
+        )
+
+    def test_compile_snapshot(self):
+        """
+        Test snapshot is compiled without refresher and warm-up.
+        """
+        path = os.path.join(self.directory, 'deploy.cfg')
+        snapshot_path = os.path.join(self.directory, 'snapshot.bin')
+        with open(path, 'w') as cfg:
+            cfg.write(
+                'DATA_CSV = {!r}\nDATA_XML = {!r}\nDATA_SNAPSHOT = {!r}\n'
+                'DATA_REFRESH_INTERVAL = 5\nWARM_UP = True\n'.format(
+                    str(TEST_DATA_CSV), str(TEST_DATA_XML), str(snapshot_path)
+                ).encode('utf-8')
+            )
+        config = dict(main.app.config)
+        self.addCleanup(main.app.config.update, config)
+        for name in ('DATA_SNAPSHOT', 'DATA_SNAPSHOT_SHARED',
+                     'DATA_REFRESH_INTERVAL', 'WARM_UP'):
+            self.addCleanup(main.app.config.pop, name, None)
+        self.addCleanup(setattr, script, 'DEPLOY_CFG', script.DEPLOY_CFG)
+        self.addCleanup(utils.clear_cache)
+        self.addCleanup(setattr, sys, 'stdout', sys.stdout)
+        script.DEPLOY_CFG = path
+        sys.stdout = io.BytesIO()
+        utils.clear_cache()
+        started = []
+        for module, name in ((utils, 'start_refresher'), (warmup, 'start')):
+            self.addCleanup(setattr, module, name, getattr(module, name))
+            setattr(module, name, lambda *args, **kwargs: started.append(1))
+
+        script.compile_snapshot()
+        self.assertListEqual(started, [])
+        self.assertItemsEqual(
+            snapshot.read_presence(snapshot_path).keys(), [10, 11]
+        )
+
+    def test_prefork_respawn(self):
+        """
+        Test workers exiting right after start stop serving.
+        """
+        script.RESPAWN_MAX_FAILURES = 3
+        handler = signal.getsignal(signal.SIGTERM)
+        self.assertRaises(SystemExit, script._prefork, self.mark, 1)
+        self.assertEqual(self.count_marks(), 3)
+        self.assertEqual(signal.getsignal(signal.SIGTERM), handler)
+
+    def test_prefork_stop(self):
+        """
+        Test exited workers are replaced until SIGTERM stops all of them.
+        """
+        script.RESPAWN_MIN_UPTIME = 0
+
+        def serve():  # pylint: disable=missing-docstring
+            self.mark()
+            sleep(0.05)
+
+        def terminate():  # pylint: disable=missing-docstring
+            started = tm()
+            while self.count_marks() < 6 and tm() - started < 10:
+                sleep(0.01)
+            os.kill(os.getpid(), signal.SIGTERM)
+
+        thread = threading.Thread(target=terminate)
+        thread.start()
+        script._prefork(serve, 2)
+        thread.join()
+        self.assertGreaterEqual(self.count_marks(), 6)
+
+
 def suite():
     """
     Default test suite.
@@ -401,6 +1852,10 @@ def suite():
     base_suite = unittest.TestSuite()
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerViewsTestCase))
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerUtilsTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceStoreTestCase))
+    base_suite.addTest(unittest.makeSuite(SnapshotTestCase))
+    base_suite.addTest(unittest.makeSuite(BenchmarkTestCase))
+    base_suite.addTest(unittest.makeSuite(ScriptTestCase))
     return base_suite
 
 
@@ -4,18 +4,34 @@ Helper functions used in views.
 """
 
 import csv
+import io
 import logging
+import os
+import struct
+import unicodedata
 
-from json import dumps
-from functools import wraps
+from array import array
+from collections import OrderedDict
+from hashlib import md5
+from functools import partial, wraps
 from datetime import datetime
-from threading import Lock
+from itertools import izip
+from multiprocessing import Pool
+from threading import Event, Lock, Thread
 from time import time
 
-from flask import Response
+from flask import Response, g, request
 from lxml import etree
+from werkzeug.http import is_resource_modified
 
+try:
+    from simplejson import JSONEncoder, dumps
+except ImportError:
+    from json import JSONEncoder, dumps
+
+from presence_analyzer import metrics, snapshot
 from presence_analyzer.main import app
+from presence_analyzer.store import PresenceStore, UserTable
 
 
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
@@ -23,56 +39,539 @@ log = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
 CACHE = {}
 
+# memoized functions watching files, refreshed by Refresher
+WATCHED = []
+
+# running Refresher, see start_refresher
+REFRESHER = None
+
+# process pool parsing large CSV files, see start_pool
+POOL = None
+
+# watched values don't expire, file changes trigger reload
+WATCH_DURATION = float('inf')
+
+# approximate size in bytes of chunks sent by streamed JSON responses
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# default limit in bytes of cached JSON responses
+RESPONSE_CACHE_SIZE = 16 * 1024 * 1024
+
+# smallest CSV file in bytes worth parsing in parallel
+PARALLEL_MIN_SIZE = 1024 * 1024
+
+# sort order of Polish letters, placed after all other unicode characters
+POLISH_COLLATION = {
+    letter: 0x110000 + index
+    for index, letter in enumerate(
+        u'aąbcćdeęfghijklłmnńoópqrsśtuvwxyzźż'
+    )
+}
+
+
+class LRUCache(object):
+    """
+    Thread safe LRU cache with per-entry expiration time.
+
+    Concurrent misses of the same key wait for a single load, other keys
+    are served and loaded independently.
+
+    Maxsize limits amount of entries, or their total weight if weigh
+    function is given.
+    """
+
+    def __init__(self, maxsize, weigh=None):
+        self.maxsize = maxsize
+        self.weigh = weigh
+        self.size = 0
+        self.entries = OrderedDict()
+        self.loading = {}
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.load_time = 0.0
+
+    def get(self, key, loader, duration, source=None):
+        """
+        Returns value for key, calls loader if missing or expired.
+        """
+        while True:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry is not None and entry['time'] > time():
+                    self.hits += 1
+                    self.entries[key] = self.entries.pop(key)
+                    return entry['value']
+                event = self.loading.get(key)
+                if event is None:
+                    self.misses += 1
+                    event = self.loading[key] = Event()
+                    break
+            # other thread loads this key, reuse its result
+            event.wait()
+
+        return self._load(key, loader, duration, event, source)
+
+    def get_watched(self, key, loader, path, interval):
+        """
+        Returns value for key, reloads it when file under path changed.
+
+        File is checked at most once per interval seconds. Changed file is
+        reloaded in background thread, old value is served meanwhile.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries[key] = self.entries.pop(key)
+                if time() - entry['checked'] < interval:
+                    self.hits += 1
+                    return entry['value']
+                entry['checked'] = time()
+
+        source = file_signature(path)
+        if entry is None:
+            return self.get(key, loader, WATCH_DURATION, source)
+
+        if source != entry['source']:
+            self.reload(key, loader, WATCH_DURATION, source)
+        with self.lock:
+            self.hits += 1
+        return entry['value']
+
+    def reload(self, key, loader, duration, source=None):
+        """
+        Loads value for key in background thread unless already loading.
+        """
+        with self.lock:
+            if key in self.loading:
+                return
+            event = self.loading[key] = Event()
+
+        def _reload():  # pylint: disable=missing-docstring
+            try:
+                self._load(key, loader, duration, event, source)
+            except Exception:  # pylint: disable=broad-except
+                log.exception('Reloading %r failed', key)
+
+        thread = Thread(target=_reload)
+        thread.daemon = True
+        thread.start()
+
+    def refresh(self, key, loader, duration, source=None):
+        """
+        Loads value for key in current thread if missing, expired or loaded
+        from other source.
+
+        Returns False if value is up to date or other thread loads it.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if key in self.loading or entry is not None and \
+                    entry['source'] == source and entry['time'] > time():
+                return False
+            event = self.loading[key] = Event()
+        self._load(key, loader, duration, event, source)
+        return True
+
+    def _load(self, key, loader, duration, event, source):
+        """
+        Calls loader and stores its value, wakes up waiting threads.
+        """
+        try:
+            started = time()
+            value = loader()
+            self.set(key, value, duration, source)
+            with self.lock:
+                self.loads += 1
+                self.load_time += time() - started
+        finally:
+            with self.lock:
+                del self.loading[key]
+            event.set()
+        return value
+
+    def set(self, key, value, duration, source=None):
+        """
+        Stores value for key, evicts least recently used entries.
+
+        Source is signature of the file value was loaded from.
+        """
+        weight = self.weigh(value) if self.weigh is not None else 1
+        with self.lock:
+            self._insert(key, value, duration, source, weight)
+
+    def _insert(self, key, value, duration, source, weight):
+        """
+        Stores weighed value for key, lock must be held.
+        """
+        if key in self.entries:
+            self.size -= self.entries.pop(key)['weight']
+        if weight > self.maxsize:
+            return
+        self.entries[key] = {
+            'time': time() + duration,
+            'value': value,
+            'source': source,
+            'checked': time(),
+            'weight': weight,
+        }
+        self.size += weight
+        while self.size > self.maxsize:
+            self.size -= self.entries.popitem(last=False)[1]['weight']
+
+    def peek(self, key):
+        """
+        Returns value for key even if expired, None if missing.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+        return entry['value'] if entry is not None else None
+
+    def clear(self):
+        """
+        Removes all entries.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """
+        Returns cache counters.
+        """
+        with self.lock:
+            return {
+                'size': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'loads': self.loads,
+                'load_time': self.load_time,
+            }
+
+
+class ResponseCache(LRUCache):
+    """
+    Serialized responses of single data snapshot, weighted by length.
+
+    Storing response of a new snapshot version drops all older responses.
+    """
+
+    def __init__(self, maxsize):
+        super(ResponseCache, self).__init__(maxsize, weigh=len)
+        self.version = None
+
+    def lookup(self, version, key):
+        """
+        Returns response body stored for key and version or None.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or self.version != version:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries[key] = self.entries.pop(key)
+            return entry['value']
+
+    def store(self, version, key, body):
+        """
+        Stores response body for key and version.
+
+        Version is compared and body inserted under one lock, so body of
+        older snapshot is never stored under newer version.
+        """
+        weight = self.weigh(body)
+        with self.lock:
+            if self.version != version:
+                self.entries.clear()
+                self.size = 0
+                self.version = version
+            self._insert(key, body, WATCH_DURATION, None, weight)
+
+
+CACHE['jsonify'] = ResponseCache(RESPONSE_CACHE_SIZE)
+
 
-def memoize(duration):
+def file_signature(path):
+    """
+    Returns (mtime, size, inode) of file or None if it doesn't exist.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime, stat.st_size, stat.st_ino
+
+
+def memoize(duration, maxsize=128, watch=None):
     """
     Decorator to caching data. Set duration in seconds.
     Return data from cache if exist and not expired.
-    """
-    lock = Lock()
 
+    Results are cached per arguments, every decorated function has its
+    own LRUCache registered in CACHE under function name.
+
+    Watch is app.config key of the file function reads, or function
+    returning its path. With RELOAD_ON_CHANGE config option data doesn't
+    expire, it is reloaded when the file changes. While Refresher runs,
+    watched data is reloaded by it and requests never wait for loading
+    once the first value is cached.
+    """
     def _memoize(function):  # pylint: disable=missing-docstring
-        def __memoize(*args, **kwargs):  # pylint: disable=missing-docstring
-            key = function.__name__
-            now = time()
+        cache = CACHE[function.__name__] = LRUCache(maxsize)
 
-            with lock:
-                if key in CACHE and CACHE[key]['time'] > now:
-                    return CACHE[key]['value']
+        def _path():  # pylint: disable=missing-docstring
+            return watch() if callable(watch) else app.config[watch]
 
-                result = function(*args, **kwargs)
-                CACHE[key] = {
-                    'time': now + duration,
-                    'value': result
-                }
+        @wraps(function)
+        def __memoize(*args, **kwargs):  # pylint: disable=missing-docstring
+            key = args + tuple(sorted(kwargs.items()))
+            loader = partial(function, *args, **kwargs)
+            if watch is not None and REFRESHER is not None:
+                return cache.get(
+                    key, loader, WATCH_DURATION, file_signature(_path())
+                )
+            if watch is not None and app.config.get('RELOAD_ON_CHANGE'):
+                return cache.get_watched(
+                    key,
+                    loader,
+                    _path(),
+                    app.config.get('RELOAD_CHECK_INTERVAL', 1),
+                )
+            return cache.get(key, loader, duration)
+
+        def refresh(*args, **kwargs):
+            """
+            Reloads cached value in current thread if watched file changed.
+            """
+            key = args + tuple(sorted(kwargs.items()))
+            loader = partial(function, *args, **kwargs)
+            return cache.refresh(
+                key, loader, WATCH_DURATION, file_signature(_path())
+            )
 
-            return result
+        __memoize.cache = cache
+        if watch is not None:
+            __memoize.refresh = refresh
+            WATCHED.append(__memoize)
         return __memoize
     return _memoize
 
 
-def jsonify(function):
+class Refresher(object):
+    """
+    Background thread reloading watched data every interval seconds.
+
+    New data is loaded off the request path, cached value is replaced only
+    when it is ready, so requests keep getting the previous one meanwhile.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stopped = Event()
+        self.thread = None
+
+    def start(self):
+        """
+        Loads data in current thread and starts background refreshing.
+        """
+        self.refresh()
+        self.thread = Thread(target=self.run, name='presence-refresher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        """
+        Refreshes data until stopped.
+        """
+        while not self.stopped.wait(self.interval):
+            self.refresh()
+
+    def refresh(self):
+        """
+        Reloads data of all watched functions whose files changed.
+        """
+        for function in WATCHED:
+            try:
+                function.refresh()
+            except Exception:  # pylint: disable=broad-except
+                log.exception('Refreshing %s failed', function.__name__)
+
+    def stop(self):
+        """
+        Stops background refreshing and waits for the thread to finish.
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+def start_refresher(interval):
+    """
+    Starts Refresher, replaces the running one.
+    """
+    global REFRESHER  # pylint: disable=global-statement
+    stop_refresher()
+    refresher = Refresher(interval)
+    refresher.start()
+    REFRESHER = refresher
+    return refresher
+
+
+def stop_refresher():
+    """
+    Stops running Refresher, watched data is loaded on request again.
+    """
+    global REFRESHER  # pylint: disable=global-statement
+    if REFRESHER is not None:
+        REFRESHER.stop()
+        REFRESHER = None
+
+
+def start_pool(workers):
+    """
+    Starts process pool parsing large CSV files, replaces the running one.
+
+    Pool must be started while process runs no other threads, its forked
+    processes would inherit locks held by them.
+    """
+    global POOL  # pylint: disable=global-statement
+    stop_pool()
+    POOL = Pool(workers)
+    return POOL
+
+
+def stop_pool():
+    """
+    Stops running process pool, CSV files are parsed serially again.
+    """
+    global POOL  # pylint: disable=global-statement
+    if POOL is not None:
+        POOL.terminate()
+        POOL.join()
+        POOL = None
+
+
+def clear_cache():
+    """
+    Removes all memoized values.
+    """
+    for cache in CACHE.itervalues():
+        cache.clear()
+
+
+def jsonify(function=None, stream=False):
     """
     Creates a response with the JSON representation of wrapped function result.
+
+    Use @jsonify(stream=True) for large results, they are encoded and sent
+    in chunks instead of building the whole JSON string in memory.
+
+    GET responses carry ETag of the data snapshot and request path, when it
+    matches the one sent by client 304 is returned without calling function.
+    Not streamed GET responses are kept in the response cache until the
+    data snapshot changes. Profiled requests bypass the cache and 304.
     """
+    if function is None:
+        return partial(jsonify, stream=stream)
+
     @wraps(function)
     def inner(*args, **kwargs):
         """
         This docstring will be overridden by @wraps decorator.
         """
-        return Response(
-            dumps(function(*args, **kwargs)),
-            mimetype='application/json'
+        if request.method not in ('GET', 'HEAD'):
+            return json_response(function(*args, **kwargs), stream)
+
+        version, modified = snapshot_version()
+        etag = md5(
+            b'{}|{}'.format(version, request.full_path.encode('utf-8'))
+        ).hexdigest()
+        modified = datetime.utcfromtimestamp(int(modified))
+        profiled = getattr(g, 'profiled', False)
+        if not profiled and not is_resource_modified(
+                request.environ, etag=etag, last_modified=modified):
+            return cache_headers(Response(status=304), etag, modified)
+
+        if stream:
+            response = json_response(function(*args, **kwargs), stream)
+            return cache_headers(response, etag, modified)
+
+        responses = CACHE['jsonify']
+        responses.maxsize = app.config.get(
+            'RESPONSE_CACHE_SIZE', RESPONSE_CACHE_SIZE
         )
+        body = None
+        if not profiled:
+            body = responses.lookup(version, request.full_path)
+        if body is None:
+            result = function(*args, **kwargs)
+            with metrics.stage('json_encode'):
+                body = dumps(result)
+            responses.store(version, request.full_path, body)
+        response = Response(body, mimetype='application/json')
+        return cache_headers(response, etag, modified)
     return inner
 
 
-@memoize(600)
+def json_response(result, stream=False):
+    """
+    Creates a response with the JSON representation of result.
+    """
+    if stream:
+        return Response(iter_json(result), mimetype='application/json')
+    with metrics.stage('json_encode'):
+        body = dumps(result)
+    return Response(body, mimetype='application/json')
+
+
+def cache_headers(response, etag, modified):
+    """
+    Sets validators and Cache-Control headers of response.
+    """
+    response.set_etag(etag)
+    response.last_modified = modified
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config.get('API_CACHE_MAX_AGE', 0)
+    response.cache_control.must_revalidate = True
+    return response
+
+
+def iter_json(value, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Yields JSON representation of value in chunks of about chunk_size bytes.
+    """
+    chunk, size = [], 0
+    for part in JSONEncoder().iterencode(value):
+        chunk.append(part)
+        size += len(part)
+        if size >= chunk_size:
+            yield ''.join(chunk)
+            chunk, size = [], 0
+    if chunk:
+        yield ''.join(chunk)
+
+
+def presence_path():
+    """
+    Returns path of the file presence data is served from.
+
+    With DATA_SNAPSHOT_SHARED config option it is the data snapshot,
+    otherwise the presence CSV.
+    """
+    if app.config.get('DATA_SNAPSHOT_SHARED'):
+        return app.config['DATA_SNAPSHOT']
+    return app.config['DATA_CSV']
+
+
+@memoize(600, watch=presence_path)
+@metrics.timed('get_data')
 def get_data():
     """
-    Extracts presence data from CSV file and groups it by user_id.
+    Extracts presence data from CSV file into PresenceStore.
 
-    It creates structure like this:
+    Store behaves like a read-only version of structure like this:
     data = {
         'user_id': {
             datetime.date(2013, 10, 1): {
@@ -85,34 +584,338 @@ def get_data():
             },
         }
     }
+    but keeps entries in arrays of date ordinals and seconds since midnight.
+
+    Without cached store, data snapshot compiled from the same CSV file is
+    used and only lines appended after compiling it are parsed.
+
+    With DATA_SNAPSHOT_SHARED config option the CSV file isn't read at all,
+    store is memory-mapped from the snapshot, see read_shared_snapshot.
+
+    Running sums of users and company-wide ones are built before store is
+    served, so date range queries don't build them on request.
     """
-    data = {}
-    with open(app.config['DATA_CSV'], 'r') as csvfile:
-        presence_reader = csv.reader(csvfile, delimiter=',')
-        for i, row in enumerate(presence_reader):
-            if len(row) != 4:
-                # ignore header and footer lines
-                continue
+    path = app.config['DATA_CSV']
+    previous = get_data.cache.peek(())
+    store = None
+    if app.config.get('DATA_SNAPSHOT_SHARED'):
+        store = read_shared_snapshot(previous)
+    else:
+        if previous is None:
+            previous = read_snapshot(snapshot.read_presence)
+        if previous is not None and previous.source['path'] == path:
+            store = append_presence_csv(previous)
+        if store is None:
+            store = load_presence_csv(
+                path, app.config.get('DATA_CSV_WORKERS', 1)
+            )
+    with metrics.stage('running_sums'):
+        return store.build_running_sums()
+
+
+def read_snapshot(reader):
+    """
+    Reads data from DATA_SNAPSHOT file with reader function.
+
+    Returns None if snapshot isn't configured or can't be read.
+    """
+    path = app.config.get('DATA_SNAPSHOT')
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        return reader(path)
+    except (EnvironmentError, ValueError, struct.error):
+        log.warning('Snapshot %s is not readable', path, exc_info=True)
+        return None
+
+
+@metrics.timed('read_shared_snapshot')
+def read_shared_snapshot(previous):
+    """
+    Returns PresenceStore memory-mapped from DATA_SNAPSHOT file.
+
+    Pages of mapped file are shared by all processes serving the snapshot.
+    It is replaced by renaming new file over it, so mapping of previous store
+    is reused until the path points to another file. Previous store is also
+    kept if the new snapshot can't be read.
+    """
+    path = app.config['DATA_SNAPSHOT']
+    if previous is not None and previous.mapped_source is not None and \
+            source_signature(previous.mapped_source) == file_signature(path):
+        return previous
+    store = read_snapshot(partial(snapshot.read_presence, shared=True))
+    if store is None:
+        if previous is None:
+            raise ValueError('Data snapshot {} is not readable'.format(path))
+        return previous
+    return store
+
+
+@metrics.timed('load_presence_csv')
+def load_presence_csv(path, workers=1):
+    """
+    Parses whole presence CSV file into PresenceStore.
+
+    Files larger than PARALLEL_MIN_SIZE are split into parts for given
+    amount of workers and parsed by pool started with start_pool. Without
+    running pool they are parsed serially.
+    """
+    with open(path, 'r') as csvfile:
+        source = file_source(csvfile)
+        source.update(offset=0, tail='')
+        if workers > 1 and POOL is not None and \
+                source['size'] >= PARALLEL_MIN_SIZE:
+            store = load_presence_csv_parallel(csvfile, source, workers)
+        else:
+            store = PresenceStore.from_rows(
+                read_presence_csv(track_lines(csvfile, source))
+            )
+    store.source = source
+    return store
+
+
+def load_presence_csv_parallel(csvfile, source, workers):
+    """
+    Parses presence CSV file in running pool of worker processes.
+
+    File is split into byte ranges on line boundaries, every worker parses
+    its ranges into arrays. Arrays are joined in file order, they are used
+    by store directly if all rows are sorted by user and date, like in
+    the intranet export. Offset and tail of source are updated like
+    track_lines does.
+    """
+    tasks = [
+        (csvfile.name, begin, end)
+        for begin, end in split_lines(csvfile, source['size'], workers * 4)
+    ]
+    chunks = POOL.map(parse_csv_range, tasks)
+
+    columns = [array('i'), array('i'), array('i'), array('i')]
+    users, dates = columns[:2]
+    ordered = True
+    for chunk in chunks:
+        length = len(users)
+        for column, data in zip(columns, chunk[:4]):
+            column.fromstring(data)
+        if length and len(users) > length and \
+                (users[length - 1], dates[length - 1]) >= \
+                (users[length], dates[length]):
+            ordered = False
+        ordered = ordered and chunk[4]
+        if chunk[6]:
+            source['offset'], source['tail'] = chunk[5:]
+
+    if ordered:
+        return PresenceStore(*columns)
+    return PresenceStore.from_rows(izip(*columns))
+
+
+def split_lines(fileobj, size, chunks):
+    """
+    Returns (begin, end) byte ranges of file, split on line boundaries.
+    """
+    bounds = [0]
+    for index in xrange(1, chunks):
+        position = size * index // chunks
+        if position <= bounds[-1]:
+            continue
+        fileobj.seek(position - 1)
+        fileobj.readline()
+        position = fileobj.tell()
+        if bounds[-1] < position < size:
+            bounds.append(position)
+    bounds.append(size)
+    return zip(bounds, bounds[1:])
+
+
+def parse_csv_range(task):
+    """
+    Parses (path, begin, end) byte range of presence CSV file.
+
+    Returns bytes of users, dates, starts and ends arrays, whether rows are
+    sorted by user and date, and offset and content of the last complete
+    line in range.
+    """
+    path, begin, end = task
+    with open(path, 'r') as csvfile:
+        csvfile.seek(begin)
+        lines = io.BytesIO(csvfile.read(end - begin))
+    source = {'offset': begin, 'tail': ''}
+    users, dates = array('i'), array('i')
+    starts, ends = array('i'), array('i')
+    ordered = True
+    previous = None
+    for user_id, ordinal, start, finish in read_presence_csv(
+            track_lines(lines, source)):
+        if ordered and previous is not None and \
+                previous >= (user_id, ordinal):
+            ordered = False
+        previous = user_id, ordinal
+        users.append(user_id)
+        dates.append(ordinal)
+        starts.append(start)
+        ends.append(finish)
+    return (
+        users.tostring(), dates.tostring(), starts.tostring(),
+        ends.tostring(), ordered, source['offset'], source['tail'],
+    )
+
+
+@metrics.timed('append_presence_csv')
+def append_presence_csv(store):
+    """
+    Merges lines appended to the file since store was loaded.
+
+    Returns None if the file was truncated or rewritten in the meantime.
+    """
+    source = dict(store.source)
+    tail = source['tail']
+    with open(source['path'], 'r') as csvfile:
+        stat = os.fstat(csvfile.fileno())
+        if stat.st_ino != source['inode'] or stat.st_size < source['offset']:
+            return None
+        csvfile.seek(source['offset'] - len(tail))
+        if csvfile.read(len(tail)) != tail:
+            return None
+        if stat.st_size == source['size']:
+            return store
+        source.update(file_source(csvfile))
+        rows = list(read_presence_csv(track_lines(csvfile, source)))
+
+    log.debug('Merging %d rows appended to %s', len(rows), source['path'])
+    merged = store.merge(rows)
+    merged.source = source
+    return merged
+
+
+def file_source(fileobj):
+    """
+    Describes opened file data is loaded from.
+    """
+    stat = os.fstat(fileobj.fileno())
+    return {
+        'path': fileobj.name,
+        'inode': stat.st_ino,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+    }
+
+
+def source_signature(source):
+    """
+    Returns file signature of data source, see file_signature.
+    """
+    return source['mtime'], source['size'], source['inode']
+
+
+def track_lines(csvfile, source):
+    """
+    Yields lines of file, tracks offset and content of last complete line.
+
+    Last line without newline may be incomplete, so the next append check
+    starts before it and parses it again.
+    """
+    for line in csvfile:
+        if line.endswith('\n'):
+            source['offset'] += len(line)
+            source['tail'] = line
+        yield line
+
+
+def read_presence_csv(csvfile):
+    """
+    Yields (user_id, date ordinal, start, end) tuples from presence CSV file.
+
+    Lines in 'id,YYYY-MM-DD,HH:MM:SS,HH:MM:SS' layout are sliced by fixed
+    offsets, any other line falls back to csv module and strptime.
+    """
+    ordinals, seconds = {}, {}
+    for i, line in enumerate(csvfile):
+        try:
+            row = parse_fixed_width_line(line, ordinals, seconds)
+        except ValueError:
+            row = parse_presence_row(next(csv.reader([line]), []), i)
+        if row is not None:
+            yield row
+
+
+def parse_fixed_width_line(line, ordinals, seconds):
+    """
+    Parses presence line in fixed layout. Raises ValueError otherwise.
+
+    Ordinals and seconds dicts cache already converted date and time fields.
+    Both repeat across the file, so most of them are converted only once.
+    """
+    user_id, day, start, end = line.rstrip('\r\n').split(',')
+    try:
+        return int(user_id), ordinals[day], seconds[start], seconds[end]
+    except KeyError:
+        pass
+
+    if day not in ordinals:
+        year, month, day_of_month = day[:4], day[5:7], day[8:]
+        if (len(day) != 10 or day[4] != '-' or day[7] != '-' or
+                not (year + month + day_of_month).isdigit()):
+            raise ValueError(day)
+        ordinals[day] = datetime(
+            int(year), int(month), int(day_of_month)
+        ).toordinal()
+    for field in (start, end):
+        if field not in seconds:
+            seconds[field] = parse_time(field)
+    return int(user_id), ordinals[day], seconds[start], seconds[end]
+
+
+def parse_time(text):
+    """
+    Parses 'HH:MM:SS' string into seconds since midnight.
+    """
+    if len(text) != 8 or text[2] != ':' or text[5] != ':':
+        raise ValueError(text)
+    hours, minutes, seconds = text[:2], text[3:5], text[6:]
+    if not (hours + minutes + seconds).isdigit():
+        raise ValueError(text)
+    hours, minutes, seconds = int(hours), int(minutes), int(seconds)
+    if hours > 23 or minutes > 59 or seconds > 59:
+        raise ValueError(text)
+    return hours * 3600 + minutes * 60 + seconds
 
-            try:
-                user_id = int(row[0])
-                date = datetime.strptime(row[1], '%Y-%m-%d').date()
-                start = datetime.strptime(row[2], '%H:%M:%S').time()
-                end = datetime.strptime(row[3], '%H:%M:%S').time()
-            except (ValueError, TypeError):
-                log.debug('Problem with line %d: ', i, exc_info=True)
 
-            data.setdefault(user_id, {})[date] = {'start': start, 'end': end}
+def parse_presence_row(row, line_number):
+    """
+    Strictly parses presence CSV row, returns None for malformed rows.
+    """
+    if len(row) != 4:
+        # ignore header and footer lines
+        return None
+
+    try:
+        user_id = int(row[0])
+        day = datetime.strptime(row[1], '%Y-%m-%d').date()
+        start = datetime.strptime(row[2], '%H:%M:%S').time()
+        end = datetime.strptime(row[3], '%H:%M:%S').time()
+    except (ValueError, TypeError):
+        log.debug('Problem with line %d: ', line_number, exc_info=True)
+        return None
 
-    return data
+    return (
+        user_id,
+        day.toordinal(),
+        seconds_since_midnight(start),
+        seconds_since_midnight(end),
+    )
 
 
-@memoize(600)
+@memoize(600, watch='DATA_XML')
+@metrics.timed('get_data_xml')
 def get_data_xml():
     """
-    Get data from xml.
+    Get data from xml into UserTable.
 
-    It creates structure like this:
+    Users are read from data snapshot when it was compiled from current
+    version of the XML file.
+
+    Table behaves like a read-only version of structure like this:
     data = {
         'user_id': {
                 'avatar': 'scheme://server:port/api/images/users/user_id',
@@ -120,48 +923,169 @@ def get_data_xml():
                 }
             }
     """
-    tree = etree.parse(app.config['DATA_XML'])  # pylint: disable=no-member
-    root = tree.getroot()
-    server = root.find('server')
-    users = root.find('users')
-    result = {}
-
-    for user in users:
-        result[int(user.attrib['id'])] = {
-            'avatar': '{protocol}://{serv}:{port}{url}'.format(
-                protocol=server.find('protocol').text,
-                serv=server.find('host').text,
-                port=server.find('port').text,
-                url=user.find('avatar').text
-            ),
-            'name': user.find('name').text
-        }
+    path = app.config['DATA_XML']
+    result = read_snapshot(snapshot.read_users)
+    if result is None or result.source['path'] != path or \
+            source_signature(result.source) != file_signature(path):
+        with open(path, 'r') as xmlfile:
+            source = file_source(xmlfile)
+            result = read_users_xml(xmlfile)
+        result.source = source
 
+    result.sorted_ids = sorted(
+        result, key=lambda user_id: polish_sort_key(result[user_id]['name'])
+    )
     return result
 
 
+@metrics.timed('read_users_xml')
+def read_users_xml(xmlfile):
+    """
+    Reads users from intranet XML file into UserTable.
+
+    Elements are parsed one by one and dropped when read, so the whole
+    document is never kept in memory.
+    """
+    # pylint: disable=no-member
+    result = UserTable()
+    for _, element in etree.iterparse(xmlfile, tag=('server', 'user')):
+        if element.tag == 'server':
+            result.server = '{protocol}://{serv}:{port}'.format(
+                protocol=element.findtext('protocol'),
+                serv=element.findtext('host'),
+                port=element.findtext('port'),
+            )
+        else:
+            result.add(
+                int(element.get('id')),
+                element.findtext('name'),
+                element.findtext('avatar'),
+            )
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+    return result
+
+
+def polish_sort_key(text):
+    """
+    Returns key sorting text in Polish alphabetical order, ignoring case.
+
+    Letters are ordered after all other characters, letters with
+    diacritics outside of Polish alphabet are ordered as their base letter.
+    Other letters, like 'ø' or non-Latin ones, follow the Polish alphabet.
+    """
+    text = unicode(text)
+    key = []
+    for char in text.lower():
+        order = POLISH_COLLATION.get(char)
+        if order is None:
+            base = unicodedata.normalize('NFD', char)[0]
+            order = POLISH_COLLATION.get(base)
+        if order is None:
+            order = ord(char)
+            if char.isalpha():
+                order += 0x110000 + len(POLISH_COLLATION)
+        key.append(order)
+    return key, text
+
+
+def snapshot_version():
+    """
+    Returns version and last modification time of currently served data.
+
+    Version identifies files the data was loaded from, so it changes only
+    when reloaded data differs.
+    """
+    sources = [get_data().source, get_data_xml().source]
+    version = ';'.join(
+        '{path}:{inode}:{size}:{mtime!r}'.format(**source)
+        for source in sources
+    )
+    return version, max(source['mtime'] for source in sources)
+
+
+def weekday_of(ordinal):
+    """
+    Returns weekday (Monday is 0) of given date ordinal.
+    """
+    return (ordinal - 1) % 7
+
+
+@metrics.timed('group_by_weekday')
 def group_by_weekday(items):
     """
     Groups presence entries by weekday.
     """
     result = [[], [], [], [], [], [], []]  # one list for every day in week
-    for date in items:
-        start = items[date]['start']
-        end = items[date]['end']
-        result[date.weekday()].append(interval(start, end))
+    for ordinal, start, end in items.rows():
+        result[weekday_of(ordinal)].append(end - start)
     return result
 
 
-def mean_by_month(items):
+@metrics.timed('range_stats')
+def range_stats(items, first=None, last=None):
+    """
+    Returns aggregates of user entries from first to last date inclusive.
+
+    Items are all entries of user, None leaves the range open. Aggregates
+    have the layout of PresenceStore ones, date ranges are answered from
+    running sums of the store without scanning entries.
+    """
+    return items.store.range_aggregates(
+        items.user_id,
+        first.toordinal() if first is not None else None,
+        last.toordinal() if last is not None else None,
+    )
+
+
+@metrics.timed('company_stats')
+def company_stats(data, first=None, last=None):
+    """
+    Returns aggregates of entries of all users from first to last date
+    inclusive.
+
+    Aggregates are answered from company-wide running sums, which get_data
+    builds when store is loaded, requests don't scan entries.
+    """
+    return data.company_aggregates(
+        first.toordinal() if first is not None else None,
+        last.toordinal() if last is not None else None,
+    )
+
+
+@metrics.timed('total_by_weekday')
+def total_by_weekday(stats):
+    """
+    Returns total presence time for every weekday.
+
+    Stats are aggregates of user entries, see range_stats.
+    """
+    return list(stats['weekday_total'])
+
+
+@metrics.timed('mean_by_weekday')
+def mean_by_weekday(stats):
+    """
+    Returns mean presence time for every weekday.
+    """
+    return [
+        average(total, count) for total, count in zip(
+            stats['weekday_total'], stats['weekday_count']
+        )
+    ]
+
+
+@metrics.timed('mean_by_month')
+def mean_by_month(stats):
     """
     Groups mean presence by month.
     """
-    result = [[] for _ in range(12)]
-    for date in items:
-        start = items[date]['start']
-        end = items[date]['end']
-        result[date.month-1].append(interval(start, end))
-    return [mean(intervals) for intervals in result]
+    return [
+        average(total, count) for total, count in zip(
+            stats['month_total'], stats['month_count']
+        )
+    ]
 
 
 def seconds_since_midnight(time_to_calc):
@@ -185,22 +1109,29 @@ def mean(items):
     """
     Calculates arithmetic mean. Returns zero for empty lists.
     """
-    return float(sum(items)) / len(items) if len(items) > 0 else 0
+    return average(sum(items), len(items))
 
 
-def mean_time_of_presence(items):
+def average(total, count):
     """
-    Calculates mean time of presence.
+    Calculates arithmetic mean from sum of items and their count.
+    Returns zero for no items.
     """
-    result = {i: {'start': [], 'end': []} for i in range(7)}
+    return float(total) / count if count > 0 else 0
 
-    for date in items:
-        start = items[date]['start']
-        end = items[date]['end']
-        result[date.weekday()]['start'].append(seconds_since_midnight(start))
-        result[date.weekday()]['end'].append(seconds_since_midnight(end))
 
-    for day in result:
-        result[day]['start'] = mean(result[day]['start'])
-        result[day]['end'] = mean(result[day]['end'])
-    return result
+@metrics.timed('mean_time_of_presence')
+def mean_time_of_presence(stats):
+    """
+    Calculates mean time of presence.
+    """
+    return {
+        day: {
+            'start': average(
+                stats['weekday_start'][day], stats['weekday_count'][day]
+            ),
+            'end': average(
+                stats['weekday_end'][day], stats['weekday_count'][day]
+            ),
+        } for day in range(7)
+    }
@@ -4,16 +4,19 @@ Defines views.
 """
 import calendar
 import logging
-import locale
+from datetime import datetime
+from itertools import chain
 
-from flask import abort, make_response, redirect
+from flask import abort, make_response, redirect, request
 from flask.ext.mako import render_template  # pylint: disable=import-error
 from mako.exceptions import TopLevelLookupException
 
+from presence_analyzer import metrics, profiling, warmup
 from presence_analyzer.main import app
 from presence_analyzer.utils import (
-    jsonify, get_data, mean, group_by_weekday, mean_time_of_presence,
-    get_data_xml, mean_by_month
+    jsonify, get_data, total_by_weekday, mean_by_weekday,
+    mean_time_of_presence, get_data_xml, range_stats, company_stats, CACHE,
+    json_response
 )
 
 
@@ -49,19 +52,13 @@ def users_view():
     Users listing for dropdown.
     """
     data_xml = get_data_xml()
-    result = [
+    return [
         {
             'user_id': user_id,
             'name': data_xml[user_id]['name'],
             'avatar': data_xml[user_id]['avatar']
-        } for user_id in data_xml
+        } for user_id in data_xml.sorted_ids
     ]
-    locale.setlocale(locale.LC_COLLATE, 'pl_PL.UTF-8')
-    return sorted(
-        result,
-        cmp=locale.strcoll,
-        key=lambda sort_by: sort_by['name']
-    )
 
 
 @app.route('/api/v1/months', methods=['GET'])
@@ -83,29 +80,36 @@ def months_view():
 def presence_top_5_users_monthly_view(month):  # pylint: disable=invalid-name
     """
     Return 5 users from top of mean presence by month.
+
+    Optional 'limit' parameter changes amount of returned users.
     """
     months = calendar.month_name[1:]
     if month not in months:
         abort(404)
+    limit = request.args.get('limit', 5, type=int)
+    if limit < 1:
+        abort(400)
     data_xml = get_data_xml()
     data = get_data()
+    ranking = chain(
+        data.month_rankings[months.index(month)],
+        ((user_id, 0) for user_id in data_xml if user_id not in data)
+    )
     result = []
-    for user_id in data_xml:
+    for user_id, mean_time in ranking:
+        if user_id not in data_xml:
+            continue
         result.append(
             {
                 'avatar': data_xml[user_id]['avatar'],
                 'user_id': user_id,
                 'name': data_xml[user_id]['name'],
-                'mean': mean_by_month(
-                    data.get(user_id, [])
-                    )[months.index(month)],
+                'mean': mean_time,
             }
         )
-    return sorted(
-        result,
-        key=lambda sort_by: sort_by['mean'],
-        reverse=True
-    )[:5]
+        if len(result) == limit:
+            break
+    return result
 
 
 @app.route('/api/v1/user_image/<int:user_id>', methods=['GET'])
@@ -122,11 +126,101 @@ def user_image_view(user_id):
     return data_xml[user_id]['avatar']
 
 
+def requested_dates():
+    """
+    Returns (first, last) dates of 'from' and 'to' query parameters.
+
+    Missing parameter is None, malformed one aborts with 400.
+    """
+    try:
+        return tuple(
+            datetime.strptime(request.args[name], '%Y-%m-%d').date()
+            if name in request.args else None
+            for name in ('from', 'to')
+        )
+    except ValueError:
+        abort(400)
+
+
+def requested_user_id(value):
+    """
+    Returns user id given as integer or its decimal string.
+
+    Aborts with 400 for other values.
+    """
+    if isinstance(value, bool) or \
+            not isinstance(value, (int, long, basestring)):
+        abort(400)
+    try:
+        return int(value)
+    except ValueError:
+        abort(400)
+
+
+def presence_weekday(stats):
+    """
+    Total presence time of user entries grouped by weekday.
+    """
+    result = [
+        (calendar.day_abbr[weekday], total)
+        for weekday, total in enumerate(total_by_weekday(stats))
+    ]
+
+    result.insert(0, ('Weekday', 'Presence (s)'))
+    return result
+
+
+def mean_time_weekday(stats):
+    """
+    Mean presence time of user entries grouped by weekday.
+    """
+    return [
+        (calendar.day_abbr[weekday], mean_time)
+        for weekday, mean_time in enumerate(mean_by_weekday(stats))
+    ]
+
+
+def presence_start_end(stats):
+    """
+    Mean start and end time of user entries grouped by weekday.
+    """
+    mean_times = mean_time_of_presence(stats)
+    return [
+        (calendar.day_abbr[weekday], mean_times[value])
+        for weekday, value in enumerate(mean_times)
+    ]
+
+
+def presence_month(stats):
+    """
+    Total presence time of entries grouped by month.
+    """
+    result = [
+        (calendar.month_name[month], total)
+        for month, total in enumerate(stats['month_total'], 1)
+    ]
+
+    result.insert(0, ('Month', 'Presence (s)'))
+    return result
+
+
+STATISTICS = {
+    'presence_weekday': presence_weekday,
+    'mean_time_weekday': mean_time_weekday,
+    'presence_start_end': presence_start_end,
+}
+
+COMPANY_STATISTICS = dict(STATISTICS, presence_month=presence_month)
+
+
 @app.route('/api/v1/presence_weekday/<int:user_id>', methods=['GET'])
 @jsonify
 def presence_weekday_view(user_id):
     """
     Returns total presence time of given user grouped by weekday.
+
+    Optional 'from' and 'to' parameters (YYYY-MM-DD) limit entries to
+    the date range.
     """
     data = get_data()
 
@@ -134,14 +228,7 @@ def presence_weekday_view(user_id):
         log.debug('User %s not found!', user_id)
         abort(404)
 
-    weekdays = group_by_weekday(data[user_id])
-    result = [
-        (calendar.day_abbr[weekday], sum(intervals))
-        for weekday, intervals in enumerate(weekdays)
-    ]
-
-    result.insert(0, ('Weekday', 'Presence (s)'))
-    return result
+    return presence_weekday(range_stats(data[user_id], *requested_dates()))
 
 
 @app.route('/api/v1/mean_time_weekday/<int:user_id>', methods=['GET'])
@@ -149,6 +236,9 @@ def presence_weekday_view(user_id):
 def mean_time_weekday_view(user_id):
     """
     Returns mean presence time of given user grouped by weekday.
+
+    Optional 'from' and 'to' parameters (YYYY-MM-DD) limit entries to
+    the date range.
     """
     data = get_data()
 
@@ -156,12 +246,7 @@ def mean_time_weekday_view(user_id):
         log.debug('User %s not found!', user_id)
         abort(404)
 
-    weekdays = group_by_weekday(data[user_id])
-    result = [
-        (calendar.day_abbr[weekday], mean(intervals))
-        for weekday, intervals in enumerate(weekdays)
-    ]
-    return result
+    return mean_time_weekday(range_stats(data[user_id], *requested_dates()))
 
 
 @app.route('/api/v1/presence_start_end/<int:user_id>', methods=['GET'])
@@ -169,15 +254,132 @@ def mean_time_weekday_view(user_id):
 def presence_start_end_view(user_id):
     """
     Returns mean time of presence.
+
+    Optional 'from' and 'to' parameters (YYYY-MM-DD) limit entries to
+    the date range.
     """
     data = get_data()
     if user_id not in data:
         log.debug('User %s not found!', user_id)
         abort(404)
 
-    mean_times = mean_time_of_presence(data[user_id])
-    result = [
-        (calendar.day_abbr[weekday], mean_times[value])
-        for weekday, value in enumerate(mean_times)
+    return presence_start_end(range_stats(data[user_id], *requested_dates()))
+
+
+@app.route('/api/v1/bulk/<stat>', methods=['GET', 'POST'])
+@jsonify(stream=True)
+def bulk_view(stat):
+    """
+    Returns statistic for many users at once, mapped by user id.
+
+    Stat is name of per user endpoint, e.g. 'presence_weekday'. Users are
+    given as 'user_id' query parameters or 'user_id' list in JSON body,
+    all users are returned by default. Unknown users are mapped to null.
+
+    Optional 'from' and 'to' parameters (YYYY-MM-DD) limit entries to
+    the date range.
+    """
+    if stat not in STATISTICS:
+        abort(404)
+
+    user_ids = [
+        requested_user_id(user_id)
+        for user_id in request.args.getlist('user_id')
     ]
-    return result
+    given = bool(user_ids)
+    if request.method == 'POST':
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict) or \
+                not isinstance(body.get('user_id'), list):
+            abort(400)
+        user_ids.extend(requested_user_id(user_id)
+                        for user_id in body['user_id'])
+        given = True
+
+    data = get_data()
+    statistic = STATISTICS[stat]
+    dates = requested_dates()
+    return {
+        user_id: statistic(range_stats(data[user_id], *dates))
+        if user_id in data else None
+        for user_id in (user_ids if given else data)
+    }
+
+
+@app.route('/api/v1/aggregate/<stat>', methods=['GET'])
+@jsonify
+def aggregate_view(stat):
+    """
+    Returns statistic of entries of all users together.
+
+    Stat is name of per user endpoint, e.g. 'presence_weekday', or
+    'presence_month' for total presence grouped by month.
+
+    Optional 'from' and 'to' parameters (YYYY-MM-DD) limit entries to
+    the date range.
+    """
+    if stat not in COMPANY_STATISTICS:
+        abort(404)
+
+    stats = company_stats(get_data(), *requested_dates())
+    return COMPANY_STATISTICS[stat](stats)
+
+
+@app.route('/api/v1/_ready', methods=['GET'])
+def ready_view():
+    """
+    Reports if warm-up is done, 503 until then or when it failed.
+    """
+    if not warmup.ready():
+        return json_response({'ready': False, 'failed': warmup.failed()}), 503
+    return json_response({'ready': True})
+
+
+@app.route('/api/v1/_metrics', methods=['GET'])
+def metrics_view():
+    """
+    Returns request and stage timings and cache counters in Prometheus
+    text format. Available only with METRICS config option.
+    """
+    if not metrics.enabled():
+        abort(404)
+
+    return make_response(
+        metrics.render(CACHE), 200, {'Content-Type': metrics.CONTENT_TYPE}
+    )
+
+
+@app.route('/api/v1/_profile', methods=['GET'])
+@app.route('/api/v1/_profile/<endpoint>', methods=['GET'])
+def profile_view(endpoint=None):
+    """
+    Returns profiling stats of views.
+
+    Without endpoint amounts of profiled requests by endpoint are listed.
+    Stats of endpoint are returned as top functions in text, 'sort' and
+    'limit' parameters change their order and amount. With 'format=pstats'
+    parameter they are downloaded as pstats file.
+    Available only in debug mode or with PROFILE_SAMPLE_RATE config option.
+    """
+    if not profiling.enabled():
+        abort(404)
+    if endpoint is None:
+        return json_response(profiling.counts())
+    if endpoint not in profiling.counts():
+        abort(404)
+
+    if request.args.get('format') == 'pstats':
+        return make_response(profiling.dump(endpoint), 200, {
+            'Content-Type': 'application/octet-stream',
+            'Content-Disposition':
+                'attachment; filename={}.pstats'.format(endpoint),
+        })
+    try:
+        text = profiling.summary(
+            endpoint,
+            request.args.get('sort', 'cumulative'),
+            request.args.get('limit', 30, type=int),
+        )
+    except KeyError:
+        abort(400)
+    return make_response(text, 200, {'Content-Type': 'text/plain'})
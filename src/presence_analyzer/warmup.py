@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Eager warm-up of data, indexes and common responses.
+
+With WARM_UP config option make_app loads presence and users data, which
+builds running sums, and renders common responses into the response cache
+before the server accepts traffic.
+WARM_UP = 'background' warms up in a thread instead, the server is then
+reported not ready until it's done.
+"""
+import calendar
+import logging
+from threading import Event, Thread
+
+from werkzeug.exceptions import HTTPException
+
+from presence_analyzer.main import app
+from presence_analyzer.utils import get_data, get_data_xml
+
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+# set after successful warm-up
+READY = Event()
+READY.set()
+
+# set when warm-up isn't running
+DONE = Event()
+DONE.set()
+
+# paths rendered once
+COMMON_PATHS = ['/api/v1/users', '/api/v1/months'] + [
+    '/api/v1/top5monthly/{}'.format(month)
+    for month in calendar.month_name[1:]
+] + [
+    '/api/v1/aggregate/{}'.format(stat) for stat in (
+        'presence_weekday', 'mean_time_weekday', 'presence_start_end',
+        'presence_month',
+    )
+]
+
+# paths rendered for every user listed in the dropdown
+USER_PATHS = (
+    '/api/v1/presence_weekday/{}',
+    '/api/v1/mean_time_weekday/{}',
+    '/api/v1/presence_start_end/{}',
+)
+
+
+def ready():
+    """
+    Tells if warm-up succeeded or wasn't started.
+    """
+    return READY.is_set()
+
+
+def failed():
+    """
+    Tells if the last warm-up finished without success.
+    """
+    return DONE.is_set() and not READY.is_set()
+
+
+def start(background=False):
+    """
+    Runs warm-up, in daemon thread when background is true.
+    """
+    READY.clear()
+    DONE.clear()
+    if not background:
+        return warm_up()
+    thread = Thread(target=warm_up, name='presence-warm-up')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def warm_up():
+    """
+    Loads data and renders common responses.
+
+    Responses are rendered without before and after request handlers, so
+    they aren't counted in metrics. Returns amount of rendered responses,
+    None when warm-up failed, the server is then never reported ready.
+    """
+    try:
+        data = get_data()
+        data_xml = get_data_xml()
+        paths = COMMON_PATHS + [
+            path.format(user_id)
+            for user_id in data_xml.sorted_ids if user_id in data
+            for path in USER_PATHS
+        ]
+        rendered = 0
+        for path in paths:
+            with app.test_request_context(path):
+                try:
+                    app.dispatch_request()
+                except HTTPException:
+                    continue
+            rendered += 1
+        log.info('Warm-up rendered %s responses', rendered)
+        READY.set()
+        return rendered
+    except Exception:  # pylint: disable=broad-except
+        log.exception('Warm-up failed')
+    finally:
+        DONE.set()